@@ -0,0 +1,185 @@
+import time
+import types
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from pathlib import Path
+from threading import Thread
+from cache import *
+
+# Benchmarks for the MessageCache expiry engine
+# Run with: python bench_cache.py [-n OUTSTANDING] [-lifetime SECONDS]
+
+BATCH_SIZES = [1, 32, 256]
+# commit with the MessageCache from before the timing wheel and the EntryStore, for the memory comparison
+BASELINE_COMMIT = '8876efe'
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# Add N messages to a cache that has a lifetime long enough so that nothing expires
+def bench_add_rate(n):
+    c = MessageCache()
+    start = time.perf_counter()
+    for i in range(n):
+        c.add_sent_message(i)
+    elapsed = time.perf_counter() - start
+    c.close()
+    print(f"[adds]   {n} outstanding: {n / elapsed:,.0f} adds/s ({elapsed:.3f}s)")
+
+
+# Ack N outstanding messages, in sending order and in reverse order (worst case for a list)
+def bench_ack_rate(n):
+    for name, order in (("fifo", range(n)), ("lifo", range(n - 1, -1, -1))):
+        c = MessageCache()
+        for i in range(n):
+            c.add_sent_message(i)
+        start = time.perf_counter()
+        for i in order:
+            c.receive_message(i)
+        elapsed = time.perf_counter() - start
+        c.close()
+        print(f"[acks]   {n} outstanding ({name}): {n / elapsed:,.0f} acks/s ({elapsed:.3f}s)")
+
+
+# Add and then ack N messages one at a time and in batches of BATCH_SIZES
+def bench_batches(n):
+    def run(name, add, ack, batches):
+        c = MessageCache()
+        start = time.perf_counter()
+        for batch in batches:
+            add(c, batch)
+        added = time.perf_counter()
+        for batch in batches:
+            ack(c, batch)
+        acked = time.perf_counter()
+        c.close()
+        print(f"[batch]  {name:>10}: {n / (added - start):,.0f} adds/s, {n / (acked - added):,.0f} acks/s")
+
+    run("single", lambda c, i: c.add_sent_message(i), lambda c, i: c.receive_message(i), range(n))
+    for size in BATCH_SIZES:
+        batches = [range(i, min(i + size, n)) for i in range(0, n, size)]
+        run(f"batch={size}", MessageCache.add_sent_messages, MessageCache.receive_messages, batches)
+
+
+# cache.py as of BASELINE_COMMIT, as a module of its own, or None outside of a git checkout
+def _load_baseline_cache():
+    try:
+        source = subprocess.run(['git', 'show', f"{BASELINE_COMMIT}:cache.py"], cwd=Path(__file__).parent,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    module = types.ModuleType('baseline_cache')
+    exec(compile(source, f"{BASELINE_COMMIT}:cache.py", 'exec'), module.__dict__)
+    return module
+
+
+# Bytes per outstanding message, for the entry storage alone and for the whole MessageCache
+def bench_memory(n):
+    # ids are hashes, so keep them out of the small int cache like real ones
+    ids = [i + 2**40 for i in range(n)]
+
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        obj = build()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return obj, (after - before) / n
+
+    def build_baseline():
+        c = baseline.MessageCache()
+        for id in ids:
+            c.add_sent_message(id)
+        return c
+
+    def build_store():
+        store = EntryStore()
+        for id in ids:
+            now = time.time()
+            store.append(id, now, now + LIFETIME)
+        return store
+
+    def build_cache():
+        c = MessageCache()
+        for id in ids:
+            c.add_sent_message(id)
+        return c
+
+    baseline = _load_baseline_cache()
+    if baseline is not None:
+        c, before = measure(build_baseline)
+        # its Timer thread is not a daemon and would keep the benchmark alive for a whole lifetime
+        c.queue.wakeup_thread._cancel_timer()
+        print(f"[memory] {n} outstanding: MessageCache at {BASELINE_COMMIT} {before:.0f} B/msg")
+    _, store = measure(build_store)
+    c, total = measure(build_cache)
+    c.close()
+    print(f"[memory] {n} outstanding: EntryStore {store:.0f} B/msg, MessageCache {total:.0f} B/msg")
+
+
+# Add N messages with a short lifetime and measure how late each one is invalidated
+def bench_expiry_lag(n, lifetime):
+    deadlines = {}
+    lags = []
+
+    def record(ids, timestamp):
+        now = time.time()
+        lags.extend(now - deadlines[id] for id in ids)
+
+    c = MessageCache(lifetime, sinks=[CallbackSink(record)])
+    for i in range(n):
+        deadlines[hash(i)] = time.time() + lifetime
+        c.add_sent_message(i)
+    while len(lags) < n:
+        time.sleep(WHEEL_TICK)
+    c.close()
+
+    lags_ms = [l * 1000 for l in lags]
+    print(f"[expiry] {n} outstanding: lag p50={_percentile(lags_ms, .5):.1f}ms"
+          f" p99={_percentile(lags_ms, .99):.1f}ms max={max(lags_ms):.1f}ms"
+          f" (tick={WHEEL_TICK * 1000:.0f}ms)")
+
+
+# Adds/s without a write-ahead log, with one, and with every publisher waiting for its group commit
+def bench_wal(n, publishers=8):
+    def run(name, **kwargs):
+        c = MessageCache(**kwargs)
+        per_thread = n // publishers
+
+        def publish(offset):
+            for i in range(offset, offset + per_thread):
+                c.add_sent_message(i)
+
+        threads = [Thread(target=publish, args=(t * per_thread,)) for t in range(publishers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        c.close()
+        print(f"[wal]    {name:>10}: {per_thread * publishers / elapsed:,.0f} adds/s with {publishers} publishers")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run("no log")
+        run("async", wal_path=f"{tmp}/async.wal")
+        run("sync", wal_path=f"{tmp}/sync.wal", wal_sync=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100_000, help="Outstanding messages")
+    parser.add_argument('-lifetime', type=float, default=2.0, help="Lifetime in s for the expiry benchmark")
+    args = parser.parse_args()
+
+    bench_add_rate(args.n)
+    bench_ack_rate(args.n)
+    bench_batches(args.n)
+    bench_memory(args.n)
+    bench_expiry_lag(args.n, args.lifetime)
+    bench_wal(args.n)
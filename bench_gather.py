@@ -0,0 +1,83 @@
+import time
+import random
+import argparse
+from datetime import datetime
+from importlib.machinery import SourceFileLoader
+
+# Micro-benchmarks for the trace processing done by `maestro gather`
+# Run with: python bench_gather.py [-n TRACES] [-corpus DIR] [-repeat N]
+
+maestro = SourceFileLoader('maestro', 'maestro').load_module()
+
+
+# Raw columns as _parse_trace leaves them, for n traces sent around the same time
+def _synthetic_columns(n):
+    start_ms = int(time.time() * 1000)
+    columns = { 'ts': [], 'poststorage_post_written_ts': [], 'poststorage_read_notification_ts': [], 'wht_start_queue_ts': [], 'wht_start_worker_ts': [] }
+    for i in range(n):
+        sent_ms = start_ms + i // 160 * 1000 + random.randint(0, 999)
+        written_ms = sent_ms + random.randint(1, 20)
+        queued_ms = written_ms + random.random() * 5
+        columns['ts'].append(sent_ms * 1000000)
+        columns['poststorage_post_written_ts'].append(written_ms)
+        columns['wht_start_queue_ts'].append(queued_ms)
+        columns['wht_start_worker_ts'].append(queued_ms + random.random() * 100)
+        columns['poststorage_read_notification_ts'].append(written_ms + random.randint(50, 200))
+    return columns
+
+
+# Previous computation, kept for comparison: three datetime pairs per trace
+def _derived_metrics_per_row(columns):
+    post_notification_diff_ms, wht_queue_duration, wht_vl_duration = [], [], []
+    for ts, written, read, queued, worker in zip(columns['ts'], columns['poststorage_post_written_ts'],
+            columns['poststorage_read_notification_ts'], columns['wht_start_queue_ts'], columns['wht_start_worker_ts']):
+        diff = datetime.fromtimestamp(read/1000.0) - datetime.fromtimestamp(written/1000.0)
+        post_notification_diff_ms.append(float(diff.total_seconds() * 1000))
+        diff = datetime.fromtimestamp(worker/1000.0) - datetime.fromtimestamp(queued/1000.0)
+        wht_queue_duration.append(float(diff.total_seconds() * 1000))
+        diff = datetime.fromtimestamp(read/1000.0) - datetime.fromtimestamp(ts/1000000000.0)
+        wht_vl_duration.append(float(diff.total_seconds() * 1000))
+    return post_notification_diff_ms, wht_queue_duration, wht_vl_duration
+
+
+# Derived metrics for n traces, per row with datetimes and vectorized over whole columns
+def bench_derived_metrics(n):
+    columns = _synthetic_columns(n)
+
+    start = time.perf_counter()
+    _derived_metrics_per_row(columns)
+    per_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    maestro._derived_metrics(dict(columns))
+    vectorized = time.perf_counter() - start
+
+    print(f"[derived] {n} traces: per row {per_row:.3f}s, vectorized {vectorized:.3f}s ({per_row / vectorized:.0f}x)")
+
+
+# Parses every dump of the fixture corpus `repeat` times, as `maestro gather -from` would
+def bench_ingest(corpus, repeat):
+    for dump_path in maestro._trace_dump_files([corpus]):
+        traces = 0
+
+        def count(trace_id, trace_info):
+            nonlocal traces
+            traces += 1
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            maestro._ingest_trace_dump(dump_path, count)
+        elapsed = time.perf_counter() - start
+        mb = dump_path.stat().st_size * repeat / 1e6
+        print(f"[ingest] {dump_path.name:>26}: {traces / elapsed:,.0f} traces/s, {mb / elapsed:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1_000_000, help="Synthetic traces")
+    parser.add_argument('-corpus', default='fixtures/traces', help="Directory with Jaeger/OTLP trace dumps")
+    parser.add_argument('-repeat', type=int, default=20, help="Times each dump is parsed")
+    args = parser.parse_args()
+
+    bench_derived_metrics(args.n)
+    bench_ingest(args.corpus, args.repeat)
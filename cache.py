@@ -1,9 +1,21 @@
+import os
+import csv
+import mmap
 import time
-from threading import Timer
+import struct
+import hashlib
+import queue
+import heapq
+import asyncio
+from array import array
+from collections import deque
+from pathlib import Path
+from threading import Condition, Event, Lock, Thread, current_thread
 from constants import *
 
-# The idea is to have a single Timer thread that will print when the oldest message has expired
-#   Using a Timer thread since they can be cancelled, apparently threads can't be killed
+# The idea is to have a single long-lived driver thread that wakes up once per tick and expires
+#   every message whose deadline fell into that tick, all in one batch
+# Deadlines live in a hashed timing wheel so scheduling and cancelling a message is O(1)
 # Use a queue for cache so you know the oldest message
 # TODO: Need to add unique id to messages from the DeathStarBench message queue, and integrate with MessageCache
 # TODO: Need to update the CacheEntry _extract_id method to work with JSON
@@ -12,15 +24,36 @@ from constants import *
 # Represents a single entry in the cache
 # We only want the message's ID and the time it was sent
 # If it's a message received, we will just ignore it's timestamp - not great but good enough for now
+# Each message carries its own deadline, since lifetimes can differ per message or per class of message
+# Slotted since the outstanding entries are kept in an EntryStore and only materialized when handed out
 class CacheEntry:
+    __slots__ = ('id', 'timestamp', 'deadline')
 
-    def __init__(self, message) -> None:
+    def __init__(self, message, lifetime: float = LIFETIME) -> None:
         self.id = self._extract_id(message)
         self.timestamp = time.time()
+        self.deadline = self.timestamp + lifetime
+
+    @classmethod
+    def _from_store(cls, id: int, timestamp: float, deadline: float) -> "CacheEntry":
+        entry = cls.__new__(cls)
+        entry.id = id
+        entry.timestamp = timestamp
+        entry.deadline = deadline
+        return entry
 
     # TODO: probably extracrt message['id'] once its JSON
-    def _extract_id(self, message) -> int:
-        return hash(message)
+    # Ids end up in the write-ahead log, so they must be the same in every process: hash() of str and
+    #   bytes is salted per interpreter, so those are digested instead, ints are already stable
+    @staticmethod
+    def _extract_id(message) -> int:
+        if isinstance(message, int):
+            return hash(message)
+        if isinstance(message, str):
+            message = message.encode()
+        elif not isinstance(message, (bytes, bytearray, memoryview)):
+            message = repr(message).encode()
+        return int.from_bytes(hashlib.blake2b(message, digest_size=8).digest(), 'little', signed=True)
 
     def get_id(self) -> int:
         return self.id
@@ -28,103 +61,968 @@ class CacheEntry:
     def get_start_time(self) -> float:
         return self.timestamp
 
+    def get_deadline(self) -> float:
+        return self.deadline
+
+
+# Lifetimes can be given as seconds or as the name of a class of messages in `lifetimes`
+#   (e.g. a replication pair like 'US->SG'), None falls back to the cache default
+def _resolve_lifetime(lifetime, default: float, lifetimes: dict) -> float:
+    if lifetime is None:
+        return default
+    if isinstance(lifetime, str):
+        return lifetimes[lifetime]
+    return lifetime
+
+
+# Hashed timing wheel: a ring of buckets, each one covering a single tick
+# A bucket maps the absolute tick an entry is due to the set of ids due then, so entries that are one
+#   or more rotations away can share the bucket with the ones due now
+# Cancelling takes the deadline the id was scheduled with instead of keeping an id -> bucket map around
+# Not thread-safe on its own, the owner is expected to hold a lock around every call
+class TimingWheel:
+
+    def __init__(self, tick: float = WHEEL_TICK, size: int = WHEEL_SIZE, now=None) -> None:
+        self.tick = tick
+        self.size = size
+        self.buckets: list[dict[int, set]] = [{} for _ in range(size)]
+        self.count = 0
+        self.current_tick = self._tick_of(time.time() if now is None else now)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _tick_of(self, deadline: float) -> int:
+        return int(deadline // self.tick)
+
+    # An id must be cancelled before it is scheduled again
+    def schedule(self, id: int, deadline: float) -> None:
+        self.schedule_many((id,), deadline)
 
-# Manages the sleeping thread
-# Can observe the stream of entries that are added to or removed from the queue
-#   If queue tells you oldest entry, can decide when to kill the sleeper and replace it with next entry
-# Also oberserves invalidations so it can reset the thread
-class WakeupThread:
-
-    def __init__(self, invalidate_oldest_queue_entry) -> None:
-        # self.wakeup_thread: None | Timer = None
-        # self.wakeup_id: None | int = None
-        self.wakeup_thread = None
-        self.wakeup_id = None
-        self.invalidate_oldest_queue_entry = invalidate_oldest_queue_entry
-
-    def _start_timer(self, entry: CacheEntry) -> None:
-        self.wakeup_id = entry.get_id()
-        self.wakeup_thread = Timer(
-            self._remaining_time(entry.get_start_time()),
-            self._call_invalidation_thread,
-            args=[],
-        )
-        self.wakeup_thread.start()
-
-    def _cancel_timer(self) -> None:
-        if self.wakeup_thread is not None:
-            self.wakeup_thread.cancel()
-
-    def _remaining_time(self, start_time: float) -> float:
-        elapsed_time = time.time() - start_time
-        remaining_time = LIFETIME - elapsed_time
-        return remaining_time
-
-    def _call_invalidation_thread(self) -> None:
-        invalidation_thread(self.wakeup_id)
-        self.invalidate_oldest_queue_entry()
-
-    def observe_new_entry(self, entry: CacheEntry) -> None:
-        if self.wakeup_thread is None:
-            self._start_timer(entry)
-
-    # def observe_remove_entry(self, entry: CacheEntry, next: CacheEntry | None) -> None:
-    def observe_remove_entry(self, entry: CacheEntry, next) -> None:
-        if entry.get_id() == self.wakeup_id:
-            self._cancel_timer()
-            if next is not None:
-                self._start_timer(next)
-            else:
-                self.wakeup_thread = None
-                self.wakeup_id = None
-
-    # def observe_invalidation(self, next_entry: CacheEntry | None) -> None:
-    def observe_invalidation(self, next_entry) -> None:
-        if next_entry is not None:
-            self._start_timer(next_entry)  # handles reset of private variables
+    # Schedules a whole batch sharing the same deadline with a single bucket lookup
+    def schedule_many(self, ids, deadline: float) -> None:
+        # deadlines in the past go to the current tick so the next advance picks them up
+        due_tick = max(self._tick_of(deadline), self.current_tick)
+        bucket = self.buckets[due_tick % self.size]
+        due = bucket.get(due_tick)
+        if due is None:
+            due = bucket[due_tick] = set()
+        before = len(due)
+        due.update(ids)
+        self.count += len(due) - before
+
+    def cancel(self, id: int, deadline: float) -> bool:
+        # an id clamped to the current tick by schedule() is still there, advance() has not run since
+        for due_tick in (self._tick_of(deadline), self.current_tick):
+            bucket = self.buckets[due_tick % self.size]
+            ids = bucket.get(due_tick)
+            if ids is not None and id in ids:
+                ids.remove(id)
+                if not ids:
+                    del bucket[due_tick]
+                self.count -= 1
+                return True
+        return False
+
+    # Returns every id due before the tick `now` falls into, i.e. a tick only fires once it is over
+    #   so an entry is never expired early and at most one tick late
+    def advance(self, now: float) -> list:
+        now_tick = self._tick_of(now)
+        if now_tick - self.current_tick >= self.size:
+            # we stalled for a whole rotation: a single pass over all buckets is enough
+            buckets = range(self.size)
         else:
-            self.wakeup_thread = None
-            self.wakeup_id = None
+            buckets = (t % self.size for t in range(self.current_tick, now_tick))
+
+        expired = []
+        for b in buckets:
+            bucket = self.buckets[b]
+            if not bucket:
+                continue
+            for due_tick in [t for t in bucket if t < now_tick]:
+                expired.extend(bucket.pop(due_tick))
+
+        self.count -= len(expired)
+        self.current_tick = max(self.current_tick, now_tick)
+        return expired
+
+
+# Compact store for the outstanding entries, with the ids, timestamps and deadlines kept in parallel
+#   array('q') / array('d') ring buffers instead of one Python object per entry
+# The ring keeps sending order, which is not expiry order once lifetimes differ, that is the wheel's job
+# Slots are addressed by an ever increasing sequence number (slot = seq & mask) and `index` maps id -> seq
+# Removing an entry leaves a tombstone behind, the head skips over them lazily and the ring is
+#   compacted when it fills up, so every operation is amortized O(1)
+class EntryStore:
+    TOMBSTONE = -1.0
+
+    def __init__(self, capacity: int = 1024) -> None:
+        # capacity has to be a power of two for the mask to work
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.ids = array('q', bytes(8 * capacity))
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.deadlines = array('d', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.head = 0
+        self.tail = 0
+        self.index: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.index
+
+    def _entry(self, slot: int) -> CacheEntry:
+        return CacheEntry._from_store(self.ids[slot], self.timestamps[slot], self.deadlines[slot])
+
+    # Yields the live entries from oldest to newest
+    def __iter__(self):
+        for seq in range(self.head, self.tail):
+            if self.timestamps[seq & self.mask] != self.TOMBSTONE:
+                yield self._entry(seq & self.mask)
+
+    def append(self, id: int, timestamp: float, deadline: float) -> None:
+        if self.tail - self.head > self.mask:
+            self._resize()
+        slot = self.tail & self.mask
+        self.ids[slot] = id
+        self.timestamps[slot] = timestamp
+        self.deadlines[slot] = deadline
+        self.index[id] = self.tail
+        self.tail += 1
+
+    # def deadline_of(self, id: int) -> float | None:
+    def deadline_of(self, id: int):
+        seq = self.index.get(id)
+        if seq is None:
+            return None
+        return self.deadlines[seq & self.mask]
+
+    # Returns the removed entry, or None if there was no entry with that id
+    # def pop(self, id: int) -> CacheEntry | None:
+    def pop(self, id: int):
+        seq = self.index.pop(id, None)
+        if seq is None:
+            return None
+        slot = seq & self.mask
+        entry = self._entry(slot)
+        self.timestamps[slot] = self.TOMBSTONE
+        # keep the head on a live entry so oldest() is O(1)
+        while self.head < self.tail and self.timestamps[self.head & self.mask] == self.TOMBSTONE:
+            self.head += 1
+        return entry
+
+    # def oldest(self) -> CacheEntry | None:
+    def oldest(self):
+        if not self.index:
+            return None
+        return self._entry(self.head & self.mask)
+
+    # def popleft(self) -> CacheEntry | None:
+    def popleft(self):
+        entry = self.oldest()
+        if entry is None:
+            return None
+        return self.pop(entry.get_id())
+
+    def _resize(self) -> None:
+        capacity = self.mask + 1
+        # only grow when the ring is mostly live, otherwise compacting the tombstones away is enough
+        if len(self.index) > capacity // 2:
+            capacity *= 2
+        ids = array('q', bytes(8 * capacity))
+        timestamps = array('d', bytes(8 * capacity))
+        deadlines = array('d', bytes(8 * capacity))
+        seq = 0
+        for old_seq in range(self.head, self.tail):
+            slot = old_seq & self.mask
+            if self.timestamps[slot] != self.TOMBSTONE:
+                ids[seq] = self.ids[slot]
+                timestamps[seq] = self.timestamps[slot]
+                deadlines[seq] = self.deadlines[slot]
+                self.index[ids[seq]] = seq
+                seq += 1
+        self.ids = ids
+        self.timestamps = timestamps
+        self.deadlines = deadlines
+        self.mask = capacity - 1
+        self.head = 0
+        self.tail = seq
+
+
+# Single long-lived thread that replaces the old per-entry Timer threads
+# Sleeps until the next tick boundary and then calls `on_tick` with the current time
+# It is a daemon so it never keeps the process alive, call stop() to terminate it earlier
+class ExpiryDriver:
+
+    def __init__(self, tick: float, on_tick) -> None:
+        self.tick = tick
+        self.on_tick = on_tick
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="cache-expiry-driver", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.tick - (time.time() % self.tick)):
+            # one failed tick (e.g. a WAL compaction) must not stop expiry, the next tick runs as usual
+            try:
+                self.on_tick(time.time())
+            except Exception as e:
+                print(f"[ERROR] Expiry tick failed: {e!r}")
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not current_thread():
+            self.thread.join()
+
+
+# Mergeable log-linear (HDR-style) histogram for the sent -> received delta, i.e. the visibility latency
+# Values are recorded in microseconds: below 2**precision every value has its own bucket, above that each
+#   power of two is split into 2**(precision - 1) linear sub-buckets, so the relative error stays under
+#   2**(1 - precision) whatever the magnitude
+# Histograms with the same precision merge by adding their counts, so per-shard or per-round ones can be combined
+# trace_summary.QuantileSummary buckets the same way for float metrics of any sign, vectorized with numpy
+class LatencyHistogram:
+
+    def __init__(self, precision: int = HISTOGRAM_PRECISION) -> None:
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+        self.counts: list[int] = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _index(self, value: int) -> int:
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    # Highest value that falls in the bucket, like HdrHistogram reports it
+    def _value(self, index: int) -> int:
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        mantissa = index - shift * self.half
+        return ((mantissa + 1) << shift) - 1
+
+    # Records a latency given in seconds, negative ones (clock skew) count as zero
+    def record(self, latency: float) -> None:
+        value = max(int(latency * 1_000_000), 0)
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        if other.precision != self.precision:
+            raise ValueError("can only merge histograms with the same precision")
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    # Latency in ms at percentile p (0-100)
+    # def percentile(self, p: float) -> float | None:
+    def percentile(self, p: float):
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1000.0
+        return self.max / 1000.0
+
+    # Summary in ms with count, min, mean, max and every percentile in HISTOGRAM_PERCENTILES
+    def snapshot(self) -> dict:
+        snapshot = {
+            'count': self.count,
+            'min': None if self.min is None else self.min / 1000.0,
+            'mean': self.total / self.count / 1000.0 if self.count else None,
+            'max': None if self.max is None else self.max / 1000.0,
+        }
+        for p in HISTOGRAM_PERCENTILES:
+            snapshot[f"p{p:g}"] = self.percentile(p)
+        return snapshot
+
+
+# Append-only log of add/ack/expire records so the outstanding messages of a MessageCache survive a restart
+# Records have a fixed size and are written straight into a memory mapped file that grows in WAL_INITIAL_SIZE
+#   steps, the unused tail is zero filled so replay stops at the first record without a kind
+# Appends never touch the disk: a commit thread msyncs everything appended since the last commit once per
+#   WAL_COMMIT_INTERVAL, or as soon as a writer needs durability (sync()), and every writer that shows up
+#   while a flush is running shares the next one
+# The log is rewritten with only the outstanding messages on open and whenever acks and expirations make
+#   it WAL_COMPACT_RATIO times bigger than that
+class WriteAheadLog:
+
+    RECORD = struct.Struct('<B7xqdd')
+    ADD, ACK, EXPIRE = 1, 2, 3
+
+    # `entries` maps id -> (timestamp, deadline) and is what the new log starts with, usually replay(path)
+    def __init__(self, path, entries=None, commit_interval: float = WAL_COMMIT_INTERVAL) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # `lock` guards appends, `map_lock` keeps the mapping alive while the commit thread flushes it
+        self.lock = Lock()
+        self.map_lock = Lock()
+        self.committed = Condition()
+        self.file = None
+        self.map = None
+        self.tail = 0
+        # log sequence numbers: records appended since open, and how many of them are on disk
+        self.lsn = 0
+        self.committed_lsn = 0
+        self.committed_offset = 0
+        self.rewrite((entries or {}).items())
+        self.stopped = Event()
+        self.wakeup = Event()
+        self.thread = Thread(target=self._run, args=(commit_interval,), daemon=True)
+        self.thread.start()
+
+    def __len__(self) -> int:
+        return self.tail // self.RECORD.size
+
+    # Returns id -> (timestamp, deadline) of the messages that were added and neither acked nor expired,
+    #   in the order they were added
+    @classmethod
+    def replay(cls, path) -> dict:
+        entries = {}
+        path = Path(path)
+        if not path.exists() or path.stat().st_size == 0:
+            return entries
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(0, len(data) - cls.RECORD.size + 1, cls.RECORD.size):
+                kind, id, timestamp, deadline = cls.RECORD.unpack_from(data, offset)
+                if kind == 0:
+                    break
+                entries.pop(id, None)
+                if kind == cls.ADD:
+                    entries[id] = (timestamp, deadline)
+        return entries
+
+    def _map(self, size: int) -> None:
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def _grow(self) -> None:
+        with self.map_lock:
+            self.map.flush()
+            self.map.close()
+            self._map(len(self.map) * 2)
+
+    def append(self, kind: int, id: int, timestamp: float, deadline: float) -> None:
+        with self.lock:
+            if self.tail + self.RECORD.size > len(self.map):
+                self._grow()
+            self.RECORD.pack_into(self.map, self.tail, kind, id, timestamp, deadline)
+            self.tail += self.RECORD.size
+            self.lsn += 1
+
+    # Batched append under a single lock acquisition
+    def append_many(self, kind: int, ids, timestamp: float, deadline: float) -> None:
+        with self.lock:
+            for id in ids:
+                if self.tail + self.RECORD.size > len(self.map):
+                    self._grow()
+                self.RECORD.pack_into(self.map, self.tail, kind, id, timestamp, deadline)
+                self.tail += self.RECORD.size
+                self.lsn += 1
+
+    # Replaces the log with one ADD record per entry, `entries` yields (id, (timestamp, deadline))
+    # Callers must make sure nothing is appended concurrently that is not part of `entries`
+    def rewrite(self, entries) -> None:
+        with self.lock, self.map_lock:
+            compacted = self.path.with_name(self.path.name + '.compact')
+            with open(compacted, 'wb') as f:
+                buffer = bytearray()
+                for id, (timestamp, deadline) in entries:
+                    buffer += self.RECORD.pack(self.ADD, id, timestamp, deadline)
+                f.write(buffer)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(compacted, self.path)
+            if self.map is not None:
+                self.map.close()
+                self.file.close()
+            self.file = open(self.path, 'r+b')
+            self.tail = len(buffer)
+            self._map(max(WAL_INITIAL_SIZE, 2 * self.tail))
+            self.committed_offset = self.tail
+            with self.committed:
+                self.committed_lsn = self.lsn
+                self.committed.notify_all()
+
+    def needs_compaction(self, outstanding: int) -> bool:
+        records = len(self)
+        return records >= WAL_COMPACT_MIN_RECORDS and records > WAL_COMPACT_RATIO * outstanding
+
+    # Flushes every record appended so far, msync needs a page aligned start
+    def commit(self) -> None:
+        with self.map_lock:
+            lsn, tail = self.lsn, self.tail
+            if lsn == self.committed_lsn:
+                return
+            start = self.committed_offset - self.committed_offset % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, tail - start)
+            self.committed_offset = tail
+        with self.committed:
+            self.committed_lsn = max(self.committed_lsn, lsn)
+            self.committed.notify_all()
+
+    # Blocks until everything appended before the call is on disk
+    def sync(self) -> None:
+        lsn = self.lsn
+        self.wakeup.set()
+        with self.committed:
+            self.committed.wait_for(lambda: self.committed_lsn >= lsn or self.stopped.is_set())
+
+    def _run(self, interval: float) -> None:
+        while not self.stopped.is_set():
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+            self.commit()
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.commit()
+        with self.committed:
+            self.committed.notify_all()
+        with self.lock, self.map_lock:
+            self.map.close()
+            # drop the zero filled tail so the file only holds records
+            self.file.truncate(self.tail)
+            self.file.close()
 
 
 # The queue is ordered by time
-# Also has a method to invalidate the oldest message, but called by invalidation function
+# Entries are kept in an EntryStore indexed by id, so acknowledging a message and finding the oldest one are both O(1)
+# Each queue is one shard of the MessageCache, with its own lock and timing wheel, and works on message ids
+# Every entry is scheduled in the wheel with its own deadline, so messages with different lifetimes can be mixed
+# Received messages feed the shard's visibility latency histogram
+# With a write-ahead log every change is appended under the shard lock, so the log sees them in order
 class Queue:
 
-    def __init__(self) -> None:
-        self.queue: list[CacheEntry] = []
-        self.wakeup_thread = WakeupThread(self._invalidate_oldest_queue_entry)
+    def __init__(self, wal: WriteAheadLog = None) -> None:
+        self.queue = EntryStore()
+        self.lock = Lock()
+        self.wheel = TimingWheel()
+        self.histogram = LatencyHistogram()
+        self.wal = wal
+
+    def __len__(self) -> int:
+        return len(self.queue)
 
-    def _invalidate_oldest_queue_entry(self) -> None:
-        self.queue.pop(0)
-        next_oldest = self._get_oldest()
-        self.wakeup_thread.observe_invalidation(next_oldest)
+    # Drops and returns every id whose deadline passed, called from the expiry driver
+    def expire(self, now: float) -> list:
+        with self.lock:
+            expired = self.wheel.advance(now)
+            for id in expired:
+                self.queue.pop(id)
+            if self.wal is not None and expired:
+                self.wal.append_many(WriteAheadLog.EXPIRE, expired, now, now)
+        return expired
 
     # def _get_oldest(self) -> CacheEntry | None:
     def _get_oldest(self):
-        if self.queue:
-            return self.queue[0]
-        return None
+        return self.queue.oldest()
+
+    def _replace(self, id: int, timestamp: float, deadline: float) -> None:
+        # a resent message moves to the back with a fresh deadline
+        previous = self.queue.pop(id)
+        if previous is not None:
+            self.wheel.cancel(id, previous.get_deadline())
+        self.queue.append(id, timestamp, deadline)
+
+    def add(self, id: int, timestamp: float, deadline: float) -> None:
+        with self.lock:
+            self._replace(id, timestamp, deadline)
+            self.wheel.schedule(id, deadline)
+            if self.wal is not None:
+                self.wal.append(WriteAheadLog.ADD, id, timestamp, deadline)
+
+    # Re-adds an entry replayed from the write-ahead log, which already holds it
+    # A deadline that passed while the cache was down lands in the current tick and expires right away
+    def restore(self, id: int, timestamp: float, deadline: float) -> None:
+        with self.lock:
+            self._replace(id, timestamp, deadline)
+            self.wheel.schedule(id, deadline)
+
+    # Batched add: the lock is taken once and the whole batch shares one deadline in the wheel
+    def add_many(self, ids: list, timestamp: float, deadline: float) -> None:
+        with self.lock:
+            for id in ids:
+                self._replace(id, timestamp, deadline)
+            self.wheel.schedule_many(ids, deadline)
+            if self.wal is not None:
+                self.wal.append_many(WriteAheadLog.ADD, ids, timestamp, deadline)
+
+    # Returns the removed entry, or None if the message was unknown or already invalidated
+    # def remove(self, id: int) -> CacheEntry | None:
+    def remove(self, id: int, now: float):
+        with self.lock:
+            entry = self.queue.pop(id)
+            if entry is not None:
+                self.wheel.cancel(id, entry.get_deadline())
+                self.histogram.record(now - entry.get_start_time())
+                if self.wal is not None:
+                    self.wal.append(WriteAheadLog.ACK, id, now, now)
+        return entry
+
+    # Batched remove under a single lock acquisition, unknown ids are skipped
+    def remove_many(self, ids: list, now: float) -> list:
+        removed = []
+        with self.lock:
+            for id in ids:
+                entry = self.queue.pop(id)
+                if entry is not None:
+                    self.wheel.cancel(id, entry.get_deadline())
+                    self.histogram.record(now - entry.get_start_time())
+                    removed.append(entry)
+            if self.wal is not None and removed:
+                self.wal.append_many(WriteAheadLog.ACK, [entry.get_id() for entry in removed], now, now)
+        return removed
+
+    # Returns a copy of the histogram, or the histogram itself when resetting it
+    def read_histogram(self, reset: bool = False) -> LatencyHistogram:
+        with self.lock:
+            histogram = self.histogram
+            if reset:
+                self.histogram = LatencyHistogram(histogram.precision)
+                return histogram
+            copy = LatencyHistogram(histogram.precision)
+            copy.merge(histogram)
+            return copy
+
 
-    def add(self, message) -> None:
-        entryObj = CacheEntry(message)
-        self.queue.append(entryObj)
-        self.wakeup_thread.observe_new_entry(entryObj)
+# Invalidation sinks: where the ids of expired messages end up
+# A sink gets whole batches, i.e. every id that expired in the same tick, together with the expiry time
+# Sinks are only ever called from the SinkDispatcher thread, never from the expiry driver
+class InvalidationSink:
 
-    def remove(self, message) -> None:
-        searchObj = CacheEntry(message)
-        removedEntry = self.queue.pop(self.queue.index(searchObj))  # Can binary search
-        self.wakeup_thread.observe_remove_entry(removedEntry, self._get_oldest())
+    def write(self, ids: list, timestamp: float) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+# Default sink, keeps the old behaviour of calling constants.invalidation_thread for every id
+class InvalidationThreadSink(InvalidationSink):
+
+    def write(self, ids: list, timestamp: float) -> None:
+        for id in ids:
+            invalidation_thread(id)
+
+
+# Only counts the invalidations
+class CounterSink(InvalidationSink):
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.batches = 0
+
+    def write(self, ids: list, timestamp: float) -> None:
+        self.count += len(ids)
+        self.batches += 1
+
+
+# Keeps the last `size` invalidations in memory as (timestamp, id) pairs
+class RingBufferSink(InvalidationSink):
+
+    def __init__(self, size: int = SINK_RING_SIZE) -> None:
+        self.log = deque(maxlen=size)
+
+    def write(self, ids: list, timestamp: float) -> None:
+        self.log.extend((timestamp, id) for id in ids)
+
+    def entries(self) -> list:
+        return list(self.log)
+
+
+# Hands every batch to a callable
+class CallbackSink(InvalidationSink):
+
+    def __init__(self, callback) -> None:
+        self.callback = callback
+
+    def write(self, ids: list, timestamp: float) -> None:
+        self.callback(ids, timestamp)
+
+
+# Appends (timestamp, id) rows to a file, either 'csv' or 'parquet'
+# Parquet needs pyarrow and buffers `row_group_size` rows per row group, the file is only valid after close()
+class FileSink(InvalidationSink):
+
+    def __init__(self, path, format: str = 'csv', row_group_size: int = 65536) -> None:
+        self.path = Path(path)
+        self.format = format
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        if format == 'csv':
+            new_file = not self.path.exists()
+            self.file = open(self.path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+            if new_file:
+                self.writer.writerow(['timestamp', 'id'])
+        elif format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.schema = pa.schema([('timestamp', pa.float64()), ('id', pa.int64())])
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+            self.row_group_size = row_group_size
+            self.timestamps = []
+            self.ids = []
+        else:
+            raise ValueError(f"unknown sink format '{format}'")
+
+    def _flush_parquet(self) -> None:
+        import pyarrow as pa
+        if self.ids:
+            self.writer.write_table(pa.table({'timestamp': self.timestamps, 'id': self.ids}, schema=self.schema))
+            self.timestamps = []
+            self.ids = []
+
+    def write(self, ids: list, timestamp: float) -> None:
+        if self.format == 'csv':
+            self.writer.writerows((timestamp, id) for id in ids)
+            self.file.flush()
+        else:
+            self.timestamps.extend([timestamp] * len(ids))
+            self.ids.extend(ids)
+            if len(self.ids) >= self.row_group_size:
+                self._flush_parquet()
+
+    def close(self) -> None:
+        if self.format == 'csv':
+            self.file.close()
+        else:
+            self._flush_parquet()
+            self.writer.close()
+
+
+# Moves sink I/O off the expiry thread: batches go through a bounded queue to a single writer thread
+# When the sinks fall SINK_QUEUE_SIZE batches behind, put() blocks so invalidations are never dropped
+class SinkDispatcher:
+
+    def __init__(self, sinks: list, maxsize: int = SINK_QUEUE_SIZE) -> None:
+        self.sinks = sinks
+        self.batches = queue.Queue(maxsize=maxsize)
+        self.thread = Thread(target=self._run, name="cache-sink-dispatcher", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+                ids, timestamp = batch
+                # a failing sink loses this batch but must not stop the others or the dispatcher
+                for sink in self.sinks:
+                    try:
+                        sink.write(ids, timestamp)
+                    except Exception as e:
+                        print(f"[ERROR] {type(sink).__name__} dropped {len(ids)} invalidations: {e!r}")
+            finally:
+                self.batches.task_done()
+
+    def put(self, ids: list, timestamp: float) -> None:
+        if ids:
+            self.batches.put((ids, timestamp))
+
+    # Blocks until every batch handed so far has been written
+    def flush(self) -> None:
+        self.batches.join()
+
+    def close(self) -> None:
+        self.batches.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
 
 
 # This is just an interface for the message queue to use
+# Thread-safe: messages are spread over CACHE_SHARDS queues by id, each one with its own lock, so concurrent
+#   publishers and ackers only contend when they hit the same shard
+# A single ExpiryDriver thread ticks every shard, and each tick's invalidations go to the sinks as one batch
+# With `wal_path` every add/ack/expiration is logged, and a cache opened on an existing log picks up the messages
+#   that were still outstanding with their original deadlines, so they expire after the remaining lifetime
+# Logged records reach the disk at most WAL_COMMIT_INTERVAL later, `wal_sync=True` makes every call wait for that
 class MessageCache:
 
-    def __init__(self) -> None:
-        self.queue = Queue()
+    def __init__(self, lifetime: float = LIFETIME, shards: int = CACHE_SHARDS, sinks=None, lifetimes=None,
+                 wal_path=None, wal_sync: bool = False) -> None:
+        self.lifetime = lifetime
+        self.lifetimes = LIFETIMES if lifetimes is None else lifetimes
+        self.wal = None
+        self.wal_sync = wal_sync
+        entries = {}
+        if wal_path is not None:
+            entries = WriteAheadLog.replay(wal_path)
+            self.wal = WriteAheadLog(wal_path, entries)
+        self.shards = [Queue(self.wal) for _ in range(shards)]
+        for id, (timestamp, deadline) in entries.items():
+            self._shard(id).restore(id, timestamp, deadline)
+        self.dispatcher = SinkDispatcher(sinks if sinks is not None else [InvalidationThreadSink()])
+        self.driver = ExpiryDriver(WHEEL_TICK, self._expire)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def _shard(self, id: int) -> Queue:
+        return self.shards[id % len(self.shards)]
+
+    # Groups ids by shard so batched calls take each shard lock once
+    def _group_by_shard(self, messages) -> dict:
+        groups = {}
+        for message in messages:
+            id = CacheEntry._extract_id(message)
+            groups.setdefault(id % len(self.shards), []).append(id)
+        return groups
+
+    def _expire(self, now: float) -> None:
+        expired = []
+        for shard in self.shards:
+            expired.extend(shard.expire(now))
+        # report outside the shard locks so slow sinks do not block publishers
+        self.dispatcher.put(expired, now)
+        if self.wal is not None and self.wal.needs_compaction(len(self)):
+            self._compact_wal()
 
-    def add_sent_message(self, message) -> None:
-        self.queue.add(message)
+    # Rewrites the log with the outstanding messages, every shard is locked so nothing is logged meanwhile
+    def _compact_wal(self) -> None:
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            self.wal.rewrite((entry.get_id(), (entry.get_start_time(), entry.get_deadline()))
+                             for shard in self.shards for entry in shard.queue)
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
+
+    def _sync(self) -> None:
+        if self.wal_sync:
+            self.wal.sync()
+
+    # `lifetime` overrides the cache default, either in seconds or as a class name from `lifetimes`
+    def add_sent_message(self, message, lifetime=None) -> None:
+        id = CacheEntry._extract_id(message)
+        timestamp = time.time()
+        deadline = timestamp + _resolve_lifetime(lifetime, self.lifetime, self.lifetimes)
+        self._shard(id).add(id, timestamp, deadline)
+        self._sync()
 
     def receive_message(self, message):
-        self.queue.remove(message)
+        id = CacheEntry._extract_id(message)
+        entry = self._shard(id).remove(id, time.time())
+        self._sync()
+        return entry
+
+    # Batched variants for consumers that get messages in bulk (e.g. RabbitMQ prefetch)
+    def add_sent_messages(self, messages, lifetime=None) -> None:
+        timestamp = time.time()
+        deadline = timestamp + _resolve_lifetime(lifetime, self.lifetime, self.lifetimes)
+        for shard, ids in self._group_by_shard(messages).items():
+            self.shards[shard].add_many(ids, timestamp, deadline)
+        self._sync()
+
+    def receive_messages(self, messages) -> list:
+        now = time.time()
+        received = []
+        for shard, ids in self._group_by_shard(messages).items():
+            received.extend(self.shards[shard].remove_many(ids, now))
+        self._sync()
+        return received
+
+    # Visibility latency (sent -> received) of every message received so far, merged over all shards
+    # With reset=True the histograms start over, so consecutive reads cover disjoint windows
+    def visibility_latency(self, reset: bool = False) -> LatencyHistogram:
+        histogram = LatencyHistogram()
+        for shard in self.shards:
+            histogram.merge(shard.read_histogram(reset))
+        return histogram
+
+    # p50/p90/p99/p99.9 (in ms) of the visibility latency, see visibility_latency()
+    def visibility_latency_snapshot(self, reset: bool = False) -> dict:
+        return self.visibility_latency(reset).snapshot()
+
+    # Blocks until every invalidation so far has reached the sinks
+    def flush(self) -> None:
+        self.dispatcher.flush()
+
+    def close(self) -> None:
+        self.driver.stop()
+        self.dispatcher.close()
+        if self.wal is not None:
+            self.wal.close()
+
+
+# asyncio-native variant of MessageCache for the workload clients that already run on an event loop
+# Not thread-safe, every call has to come from the loop thread: there are no locks and no driver thread,
+#   only the sinks run on their own SinkDispatcher thread
+# Deadlines are kept in a heap of (deadline, id) and a single loop.call_at handle always points at the top
+#   of the heap, acknowledged entries are left in the heap and skipped lazily when they reach the top
+# Coroutines can `await cache.wait_for(message, timeout)` to block on a specific ack without polling
+class AsyncMessageCache:
+
+    def __init__(self, lifetime: float = LIFETIME, sinks=None, lifetimes=None) -> None:
+        self.queue = EntryStore()
+        self.lifetime = lifetime
+        self.lifetimes = LIFETIMES if lifetimes is None else lifetimes
+        self.deadlines: list = []
+        self.histogram = LatencyHistogram()
+        self.dispatcher = SinkDispatcher(sinks if sinks is not None else [InvalidationThreadSink()])
+        self.loop = None
+        self.wakeup_handle = None
+        self.wakeup_deadline = None
+        # id -> futures waiting for that message to be received
+        self.waiters: dict[int, list] = {}
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    # Heap entries whose id was acknowledged or resent with another deadline are stale
+    def _is_stale(self, deadline: float, id: int) -> bool:
+        return self.queue.deadline_of(id) != deadline
+
+    def _compact(self) -> None:
+        # stale entries only leave the heap at the top, rebuild it when they are the majority
+        if len(self.deadlines) > 2 * len(self.queue) + 1024:
+            self.deadlines = [(d, id) for d, id in self.deadlines if not self._is_stale(d, id)]
+            heapq.heapify(self.deadlines)
+
+    def _reschedule(self) -> None:
+        while self.deadlines and self._is_stale(*self.deadlines[0]):
+            heapq.heappop(self.deadlines)
+        deadline = self.deadlines[0][0] if self.deadlines else None
+        if deadline == self.wakeup_deadline:
+            return
+        if self.wakeup_handle is not None:
+            self.wakeup_handle.cancel()
+            self.wakeup_handle = self.wakeup_deadline = None
+        if deadline is None:
+            return
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        # entries carry wall clock deadlines, the loop runs on its own monotonic clock
+        remaining = deadline - time.time()
+        self.wakeup_deadline = deadline
+        self.wakeup_handle = self.loop.call_at(self.loop.time() + max(remaining, 0), self._expire)
+
+    def _expire(self) -> None:
+        self.wakeup_handle = self.wakeup_deadline = None
+        now = time.time()
+        # everything that is due goes in the same batch
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, id = heapq.heappop(self.deadlines)
+            if not self._is_stale(deadline, id):
+                self.queue.pop(id)
+                expired.append(id)
+        self._reschedule()
+
+        for id in expired:
+            self._wake(id, None)
+        self.dispatcher.put(expired, now)
+
+    def _wake(self, id: int, entry) -> None:
+        for future in self.waiters.pop(id, ()):
+            if not future.done():
+                future.set_result(entry)
+
+    # `lifetime` overrides the cache default, either in seconds or as a class name from `lifetimes`
+    def add_sent_message(self, message, lifetime=None) -> None:
+        self.add_sent_messages((message,), lifetime)
+
+    def add_sent_messages(self, messages, lifetime=None) -> None:
+        timestamp = time.time()
+        deadline = timestamp + _resolve_lifetime(lifetime, self.lifetime, self.lifetimes)
+        for message in messages:
+            id = CacheEntry._extract_id(message)
+            # a resent message moves to the back with a fresh deadline
+            self.queue.pop(id)
+            self.queue.append(id, timestamp, deadline)
+            heapq.heappush(self.deadlines, (deadline, id))
+        self._compact()
+        self._reschedule()
+
+    # Returns the removed entry, or None if the message was unknown or already invalidated
+    # def receive_message(self, message) -> CacheEntry | None:
+    def receive_message(self, message):
+        received = self.receive_messages((message,))
+        return received[0] if received else None
+
+    def receive_messages(self, messages) -> list:
+        now = time.time()
+        received = []
+        for message in messages:
+            id = CacheEntry._extract_id(message)
+            entry = self.queue.pop(id)
+            if entry is not None:
+                self.histogram.record(now - entry.get_start_time())
+                received.append(entry)
+                self._wake(id, entry)
+        return received
+
+    # Visibility latency (sent -> received) of every message received so far
+    # With reset=True the histogram starts over, so consecutive reads cover disjoint windows
+    def visibility_latency(self, reset: bool = False) -> LatencyHistogram:
+        histogram = self.histogram
+        if reset:
+            self.histogram = LatencyHistogram(histogram.precision)
+            return histogram
+        copy = LatencyHistogram(histogram.precision)
+        copy.merge(histogram)
+        return copy
+
+    def visibility_latency_snapshot(self, reset: bool = False) -> dict:
+        return self.visibility_latency(reset).snapshot()
+
+    # Waits until the message is received and returns its entry
+    # Returns None if the message is not outstanding or gets invalidated, raises asyncio.TimeoutError on timeout
+    async def wait_for(self, message, timeout=None):
+        id = CacheEntry._extract_id(message)
+        if id not in self.queue:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(id, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self.waiters.get(id)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self.waiters[id]
+
+    # Blocks until every invalidation so far has reached the sinks
+    def flush(self) -> None:
+        self.dispatcher.flush()
+
+    def close(self) -> None:
+        if self.wakeup_handle is not None:
+            self.wakeup_handle.cancel()
+            self.wakeup_handle = self.wakeup_deadline = None
+        for futures in self.waiters.values():
+            for future in futures:
+                future.cancel()
+        self.waiters.clear()
+        self.dispatcher.close()
@@ -1,21 +1,41 @@
 ### DEFAULT CONFIG
 
-# Called with threading.Timer
-# Make it do something besides print? How??
 LIFETIME = 60
-
-
+# Per class lifetimes, messages can be added with one of these names instead of a number of seconds
+LIFETIMES = {
+    'same-region': 10,
+    'US->EU': 60,
+    'US->BR': 60,
+    'US->SG': 120,
+}
+# Timing wheel granularity: expirations fire at most WHEEL_TICK seconds late
+#   and one rotation (WHEEL_TICK * WHEEL_SIZE) should cover LIFETIME
+WHEEL_TICK = 0.1
+WHEEL_SIZE = 1024
+# Number of independently locked shards in a MessageCache
+CACHE_SHARDS = 16
+# Invalidation batches that can be waiting for the sinks before the expiry driver blocks
+SINK_QUEUE_SIZE = 1024
+# Invalidations kept by a RingBufferSink
+SINK_RING_SIZE = 10000
+# Visibility latency histogram: 2**(1 - HISTOGRAM_PRECISION) max relative error, and percentiles in snapshots
+HISTOGRAM_PRECISION = 8
+HISTOGRAM_PERCENTILES = [50, 90, 99, 99.9]
+# Write-ahead log: records are flushed to disk in groups every WAL_COMMIT_INTERVAL seconds,
+#   the log grows in steps of WAL_INITIAL_SIZE bytes and is rewritten with only the outstanding
+#   messages once it holds WAL_COMPACT_RATIO times more records than that (and at least WAL_COMPACT_MIN_RECORDS)
+WAL_COMMIT_INTERVAL = 0.01
+WAL_INITIAL_SIZE = 1 << 20
+WAL_COMPACT_RATIO = 4
+WAL_COMPACT_MIN_RECORDS = 1 << 16
+
+
+# Called by the default InvalidationThreadSink, pass other sinks to MessageCache to do something besides print
 def invalidation_thread(name) -> None:
     print(f"{name} failed to receive response in time")
 
 
 ### TEST CONFIG
 # LIFETIME = 3
+# tests count invalidations with a CounterSink instead of overriding invalidation_thread
 
-invalidation_count = 0
-
-
-# def invalidation_thread(name):
-#     print(f"{name} failed to receive response in time")
-#     global invalidation_count
-#     invalidation_count += 1
@@ -1,62 +1,490 @@
 from cache import *
-import constants
+import asyncio
+import subprocess
+import sys
+from collections import deque
+from threading import Event, Thread
 
 
 def test_queue():
-    prior_count = constants.invalidation_count
-    oldest_time = time.time()
-    cache = MessageCache()
+    counter = CounterSink()
+    cache = MessageCache(sinks=[counter])
     for i in range(10):
         # print("added message", i)
         cache.add_sent_message(i)
-    cache.queue.wakeup_thread._cancel_timer()
-    while cache.queue.queue:
-        popped = cache.queue.queue.pop(0)
-        # print("popped", popped.get_start_time())
-        assert popped.get_start_time() > oldest_time
-        oldest_time = popped.get_start_time()
-    assert constants.invalidation_count == prior_count == 0
+    cache.close()
+    assert len(cache) == 10
+    for shard in cache.shards:
+        oldest_time = 0
+        while shard.queue:
+            popped = shard.queue.popleft()
+            # print("popped", popped.get_start_time())
+            assert popped.get_start_time() > oldest_time
+            oldest_time = popped.get_start_time()
+    assert counter.count == 0
 
 
 def test_cancel():
-    prior_count = constants.invalidation_count
-    cache = MessageCache()
+    counter = CounterSink()
+    cache = MessageCache(sinks=[counter])
     cache.add_sent_message(1)
-    cache.queue.wakeup_thread._cancel_timer()
-    time.sleep(LIFETIME)
-    assert constants.invalidation_count == prior_count == 0
+    shard = cache._shard(1)
+    with shard.lock:
+        entry = shard._get_oldest()
+        shard.wheel.cancel(entry.get_id(), entry.get_deadline())
+    time.sleep(LIFETIME + WHEEL_TICK)
+    cache.flush()
+    assert counter.count == 0
 
 
 def test_invalidating_thread():
-    prior_count = constants.invalidation_count
-    cache = MessageCache()
+    counter = CounterSink()
+    cache = MessageCache(sinks=[counter])
     cache.add_sent_message(1)
-    time.sleep(LIFETIME)
+    time.sleep(LIFETIME + WHEEL_TICK)
+    cache.flush()
     # print("waiting done")
-    # print(constants.invalidation_count)
-    assert (
-        constants.invalidation_count == prior_count + 1
-    ), f"constants.invalidation_count: {constants.invalidation_count}, prior_count: {prior_count}"
-    assert cache.queue.queue == []
+    # print(counter.count)
+    assert counter.count == 1, f"counter.count: {counter.count}"
+    assert len(cache) == 0
 
 
 def test_2_invalidating_thread():
-    prior_count = constants.invalidation_count
-    cache = MessageCache()
+    counter = CounterSink()
+    cache = MessageCache(sinks=[counter])
     cache.add_sent_message(1)
     time.sleep(2)
     cache.add_sent_message(2)
-    time.sleep(LIFETIME - 2)
+    time.sleep(LIFETIME - 2 + WHEEL_TICK)
+    cache.flush()
     # print("waiting done")
-    # print(constants.invalidation_count)
-    assert (
-        constants.invalidation_count == prior_count + 1
-    ), f"constants.invalidation_count: {constants.invalidation_count}, prior_count: {prior_count}"
-    assert len(cache.queue.queue) == 1 and cache.queue.queue[0].get_id() == 2
+    # print(counter.count)
+    assert counter.count == 1, f"counter.count: {counter.count}"
+    assert len(cache) == 1 and cache._shard(2)._get_oldest().get_id() == 2
     time.sleep(LIFETIME)
-    assert (
-        constants.invalidation_count == prior_count + 2
-    ), f"constants.invalidation_count: {constants.invalidation_count}, prior_count: {prior_count}"
+    cache.flush()
+    assert counter.count == 2, f"counter.count: {counter.count}"
+
+
+def test_wheel_batches_same_tick():
+    wheel = TimingWheel(tick=1, size=8, now=0)
+    wheel.schedule(1, 2.1)
+    wheel.schedule(2, 2.9)
+    wheel.schedule(3, 3.5)
+    assert wheel.advance(2.9) == []
+    assert sorted(wheel.advance(3.0)) == [1, 2]
+    assert wheel.advance(4.0) == [3]
+    assert len(wheel) == 0
+
+
+def test_wheel_cancel():
+    wheel = TimingWheel(tick=1, size=8, now=0)
+    wheel.schedule(1, 2.5)
+    wheel.schedule(2, 2.5)
+    assert wheel.cancel(1, 2.5)
+    assert not wheel.cancel(1, 2.5)
+    assert wheel.advance(10) == [2]
+    # ids scheduled in the past are cancelled from the current tick
+    wheel.schedule(3, 1.0)
+    assert wheel.cancel(3, 1.0)
+    assert wheel.advance(20) == []
+    assert len(wheel) == 0
+
+
+def test_wheel_rotations():
+    wheel = TimingWheel(tick=1, size=4, now=0)
+    wheel.schedule(1, 1.5)
+    wheel.schedule(2, 5.5)  # same bucket, one rotation later
+    wheel.schedule(3, 100)  # way past a full rotation
+    assert wheel.advance(2) == [1]
+    assert wheel.advance(6) == [2]
+    assert wheel.advance(50) == []
+    assert wheel.advance(101) == [3]
+
+
+def test_wheel_past_deadline():
+    wheel = TimingWheel(tick=1, size=4, now=10)
+    wheel.schedule(1, 3)
+    assert wheel.advance(11) == [1]
+
+
+def test_short_lifetime_expiry():
+    cache = MessageCache(lifetime=0.2)
+    cache.add_sent_message(1)
+    cache.add_sent_message(2)
+    time.sleep(0.2 + 3 * WHEEL_TICK)
+    assert len(cache) == 0
+    assert all(len(shard.wheel) == 0 for shard in cache.shards)
+    cache.close()
+
+
+def test_receive_message():
+    cache = MessageCache(lifetime=0.2, shards=1)
+    shard = cache.shards[0]
+    for i in range(5):
+        cache.add_sent_message(i)
+    received = cache.receive_message(2)
+    assert received.get_id() == 2
+    assert [e.get_id() for e in shard.queue] == [0, 1, 3, 4]
+    assert shard._get_oldest().get_id() == 0
+    # unknown or already received messages are ignored
+    assert cache.receive_message(2) is None
+    assert cache.receive_message(42) is None
+    for i in (0, 1, 3, 4):
+        cache.receive_message(i)
+    assert shard._get_oldest() is None
+    assert len(shard.wheel) == 0
+    cache.close()
+
+
+def test_batched_add_and_receive():
+    cache = MessageCache(lifetime=0.2, shards=1)
+    shard = cache.shards[0]
+    cache.add_sent_messages(range(10))
+    cache.add_sent_message(10)
+    # all of the batch shares the same timestamp
+    assert len({e.get_start_time() for e in list(shard.queue)[:10]}) == 1
+    assert len(shard.wheel) == 11
+    received = cache.receive_messages([3, 4, 42, 3])
+    assert [e.get_id() for e in received] == [3, 4]
+    assert len(shard.queue) == 9 and len(shard.wheel) == 9
+    # resending part of the batch reschedules it
+    cache.add_sent_messages([0, 0, 1])
+    assert len(shard.queue) == 9 and len(shard.wheel) == 9
+    assert [e.get_id() for e in shard.queue][-2:] == [0, 1]
+    time.sleep(0.2 + 3 * WHEEL_TICK)
+    assert len(shard.queue) == 0 and len(shard.wheel) == 0
+    cache.close()
+
+
+# N publishers, M ackers and the expiry driver all hitting the cache at the same time
+# Every message has to end up either acknowledged or invalidated, exactly once
+def test_concurrent_publishers_ackers_and_expiry():
+    publishers, ackers, per_publisher = 4, 3, 5000
+    invalidated = []
+    acked = []
+    published = deque()
+    errors = []
+    done_publishing = Event()
+
+    def publish(p):
+        try:
+            ids = range(p * per_publisher, (p + 1) * per_publisher)
+            for start in range(ids.start, ids.stop, 50):
+                batch = range(start, start + 50)
+                # mix single and batched calls
+                if start % 100:
+                    cache.add_sent_messages(batch)
+                else:
+                    for i in batch:
+                        cache.add_sent_message(i)
+                published.extend(batch)
+        except Exception as e:
+            errors.append(e)
+
+    def ack():
+        try:
+            while not (done_publishing.is_set() and not published):
+                try:
+                    id = published.popleft()
+                except IndexError:
+                    time.sleep(0.001)
+                    continue
+                # leave every third message to expire
+                if id % 3:
+                    entry = cache.receive_message(id)
+                    if entry is not None:
+                        acked.append(entry.get_id())
+        except Exception as e:
+            errors.append(e)
+
+    cache = MessageCache(lifetime=0.05, shards=4, sinks=[CallbackSink(lambda ids, ts: invalidated.extend(ids))])
+    threads = [Thread(target=publish, args=(p,)) for p in range(publishers)]
+    threads += [Thread(target=ack) for _ in range(ackers)]
+    for t in threads:
+        t.start()
+    for t in threads[:publishers]:
+        t.join()
+    done_publishing.set()
+    for t in threads[publishers:]:
+        t.join()
+    time.sleep(0.05 + 3 * WHEEL_TICK)
+    cache.close()
+
+    total = publishers * per_publisher
+    assert not errors
+    assert len(acked) == len(set(acked))
+    assert len(invalidated) == len(set(invalidated))
+    assert set(acked).isdisjoint(invalidated)
+    assert set(acked) | set(invalidated) == set(range(total))
+    assert all(i % 3 for i in acked)
+    assert len(cache) == 0
+    assert all(len(shard.wheel) == 0 for shard in cache.shards)
+
+
+def test_async_expiry():
+    invalidated = []
+
+    async def main():
+        cache = AsyncMessageCache(lifetime=0.1, sinks=[CallbackSink(lambda ids, ts: invalidated.extend(ids))])
+        cache.add_sent_messages([1, 2])
+        await asyncio.sleep(0.05)
+        cache.add_sent_message(3)
+        # acking the oldest leaves it in the heap until it reaches the top
+        assert cache.receive_message(1).get_id() == 1
+        await asyncio.sleep(0.07)
+        cache.flush()
+        assert invalidated == [2] and len(cache) == 1
+        await asyncio.sleep(0.05)
+        cache.flush()
+        assert invalidated == [2, 3] and len(cache) == 0
+        assert cache.wakeup_handle is None
+        cache.close()
+
+    asyncio.run(main())
+
+
+def test_async_wait_for():
+    async def main():
+        cache = AsyncMessageCache(lifetime=0.2, sinks=[CounterSink()])
+        cache.add_sent_messages([1, 2, 3])
+        waiter = asyncio.ensure_future(cache.wait_for(1))
+        asyncio.get_running_loop().call_later(0.01, cache.receive_message, 1)
+        assert (await waiter).get_id() == 1
+        # not outstanding anymore
+        assert await cache.wait_for(1) is None
+        try:
+            await cache.wait_for(2, timeout=0.01)
+            assert False, "wait_for should have timed out"
+        except asyncio.TimeoutError:
+            pass
+        assert not cache.waiters
+        # invalidated messages wake their waiters with None
+        assert await cache.wait_for(3, timeout=1) is None
+        cache.close()
+
+    asyncio.run(main())
+
+
+def test_per_message_lifetimes():
+    invalidated = []
+    cache = MessageCache(lifetime=10, lifetimes={'fast': 0.1}, sinks=[CallbackSink(lambda ids, ts: invalidated.extend(ids))])
+    cache.add_sent_message(1)
+    cache.add_sent_message(2, lifetime=0.3)
+    cache.add_sent_messages([3, 4], lifetime='fast')
+    entry = cache._shard(2)._get_oldest()
+    assert abs(entry.get_deadline() - entry.get_start_time() - 0.3) < 1e-6
+    time.sleep(0.1 + 2 * WHEEL_TICK)
+    cache.flush()
+    # later messages with shorter lifetimes expire first
+    assert sorted(invalidated) == [3, 4]
+    time.sleep(0.2 + WHEEL_TICK)
+    cache.flush()
+    assert sorted(invalidated) == [2, 3, 4]
+    assert len(cache) == 1 and cache.receive_message(1) is not None
+    cache.close()
+
+
+def test_async_per_message_lifetimes():
+    invalidated = []
+
+    async def main():
+        cache = AsyncMessageCache(lifetime=10, lifetimes={'fast': 0.05}, sinks=[CallbackSink(lambda ids, ts: invalidated.extend(ids))])
+        cache.add_sent_message(1)
+        cache.add_sent_message(2, lifetime=0.15)
+        cache.add_sent_messages([3, 4], lifetime='fast')
+        assert cache.wakeup_deadline == cache.queue.deadline_of(3)
+        cache.receive_message(3)
+        await asyncio.sleep(0.1)
+        cache.flush()
+        assert invalidated == [4]
+        await asyncio.sleep(0.1)
+        cache.flush()
+        assert invalidated == [4, 2]
+        assert len(cache) == 1 and cache.wakeup_deadline == cache.queue.deadline_of(1)
+        cache.close()
+
+    asyncio.run(main())
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram(precision=8)
+    for ms in range(1, 1001):
+        histogram.record(ms / 1000.0)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 1000 and snapshot['min'] == 1.0 and snapshot['max'] == 1000.0
+    for p, expected in ((50, 500), (90, 900), (99, 990), (99.9, 999)):
+        assert abs(snapshot[f"p{p:g}"] - expected) / expected < 2 ** -7
+    # merging is the same as recording everything in one histogram
+    other = LatencyHistogram(precision=8)
+    for ms in range(1001, 2001):
+        other.record(ms / 1000.0)
+    histogram.merge(other)
+    assert len(histogram) == 2000 and histogram.snapshot()['max'] == 2000.0
+    assert abs(histogram.percentile(50) - 1000) / 1000 < 2 ** -7
+    assert LatencyHistogram().percentile(50) is None
+
+
+def test_visibility_latency():
+    cache = MessageCache(sinks=[CounterSink()])
+    cache.add_sent_messages(range(10))
+    time.sleep(0.05)
+    cache.receive_messages(range(5))
+    cache.receive_message(5)
+    snapshot = cache.visibility_latency_snapshot(reset=True)
+    assert snapshot['count'] == 6
+    assert 50 <= snapshot['p50'] < 100 and snapshot['p99.9'] >= snapshot['p50']
+    # reset on read
+    assert cache.visibility_latency_snapshot()['count'] == 0
+    cache.receive_messages(range(6, 10))
+    assert len(cache.visibility_latency()) == 4
+    cache.close()
+
+
+def test_sinks():
+    counter = CounterSink()
+    ring = RingBufferSink(size=3)
+    batches = []
+    sinks = [counter, ring, CallbackSink(lambda ids, ts: batches.append(sorted(ids)))]
+    cache = MessageCache(lifetime=0.1, shards=2, sinks=sinks)
+    cache.add_sent_messages(range(5))
+    time.sleep(0.1 + 3 * WHEEL_TICK)
+    cache.close()
+    # a whole tick is delivered as one batch
+    assert counter.count == 5 and counter.batches == 1
+    assert batches == [[0, 1, 2, 3, 4]]
+    assert len(ring.entries()) == 3
+
+
+def test_failing_sink_and_tick():
+    counter = CounterSink()
+
+    def fail(ids, ts):
+        raise RuntimeError('sink is down')
+
+    cache = MessageCache(lifetime=0.1, shards=2, sinks=[CallbackSink(fail), counter])
+    on_tick = cache.driver.on_tick
+    ticks = []
+
+    def fail_once(now):
+        ticks.append(now)
+        if len(ticks) == 1:
+            raise RuntimeError('tick failed')
+        on_tick(now)
+
+    cache.driver.on_tick = fail_once
+    cache.add_sent_messages(range(3))
+    time.sleep(0.1 + 3 * WHEEL_TICK)
+    cache.add_sent_messages(range(3, 5))
+    time.sleep(0.1 + 3 * WHEEL_TICK)
+    # neither the failing sink nor the failed tick stop the batches after them
+    cache.flush()
+    assert counter.count == 5
+    cache.close()
+
+
+def test_file_sink(tmp_path):
+    sink = FileSink(tmp_path / 'invalidations.csv')
+    sink.write([1, 2], 10.0)
+    sink.write([3], 11.0)
+    sink.close()
+    with open(tmp_path / 'invalidations.csv') as f:
+        assert f.read().split() == ['timestamp,id', '10.0,1', '10.0,2', '11.0,3']
+
+
+def test_entry_store_order_and_tombstones():
+    store = EntryStore(capacity=4)
+    for i in range(4):
+        store.append(i, float(i), i + 60.0)
+    assert store.pop(0).get_start_time() == 0.0
+    assert store.pop(2).get_deadline() == 62.0
+    assert store.pop(2) is None
+    assert store.deadline_of(2) is None and store.deadline_of(3) == 63.0
+    assert store.oldest().get_id() == 1
+    # ring is full of tombstones and live entries, appending compacts or grows it
+    for i in range(4, 10):
+        store.append(i, float(i), i + 60.0)
+    assert [e.get_id() for e in store] == [1, 3, 4, 5, 6, 7, 8, 9]
+    assert [e.get_start_time() for e in store] == [1.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0]
+    assert [e.get_deadline() for e in store] == [61.0, 63.0, 64.0, 65.0, 66.0, 67.0, 68.0, 69.0]
+    assert store.popleft().get_id() == 1
+    assert len(store) == 7 and 9 in store and 1 not in store
+
+
+def test_entry_store_churn():
+    store = EntryStore(capacity=2)
+    # out of order acks keep the ring from growing unbounded
+    for i in range(10000):
+        store.append(i, float(i), float(i))
+        if i % 2:
+            store.pop(i - 1)
+    assert len(store) == 5000
+    assert store.mask + 1 <= 16384
+    assert store.oldest().get_id() == 1
+    assert [e.get_id() for e in store][-1] == 9999
+
+
+def test_wal_replay(tmp_path):
+    path = tmp_path / 'cache.wal'
+    sink = CounterSink()
+    cache = MessageCache(lifetime=60, sinks=[sink], wal_path=path)
+    cache.add_sent_messages([1, 2, 3])
+    cache.add_sent_message(4, lifetime=0.2)
+    cache.receive_message(2)
+    deadline = cache._shard(hash(1)).queue.deadline_of(hash(1))
+    cache.close()
+
+    # acked messages are not replayed, the others keep their original deadline
+    sink = CounterSink()
+    cache = MessageCache(lifetime=60, sinks=[sink], wal_path=path)
+    assert cache._shard(hash(1)).queue.deadline_of(hash(1)) == deadline
+    assert cache._shard(hash(2)).queue.deadline_of(hash(2)) is None
+    # 4 ran out of lifetime during the restart and is invalidated right away
+    time.sleep(0.2 + 3 * WHEEL_TICK)
+    cache.flush()
+    assert sink.count == 1
+    assert len(cache) == 2
+    cache.close()
+
+    assert set(WriteAheadLog.replay(path)) == {hash(1), hash(3)}
+
+
+def test_wal_compaction_and_sync(tmp_path):
+    path = tmp_path / 'cache.wal'
+    cache = MessageCache(sinks=[CounterSink()], wal_path=path, wal_sync=True)
+    for i in range(100):
+        cache.add_sent_message(i)
+        cache.receive_message(i)
+    cache.add_sent_message('outstanding')
+    assert len(cache.wal) == 201
+    cache._compact_wal()
+    assert len(cache.wal) == 1
+    cache.add_sent_message('after compaction')
+    # everything appended before sync() returns is on disk, even without closing the cache
+    cache.wal.sync()
+    assert set(WriteAheadLog.replay(path)) == {CacheEntry._extract_id('outstanding'), CacheEntry._extract_id('after compaction')}
+    cache.close()
+
+
+
+def test_wal_replay_across_processes(tmp_path):
+    path = tmp_path / 'cache.wal'
+
+    # every process gets its own hash seed, like separate runs of the same service would
+    def run(seed, code):
+        env = dict(os.environ, PYTHONHASHSEED=str(seed))
+        subprocess.run([sys.executable, '-c', 'from cache import *\n' + code], cwd=Path(__file__).parent,
+                       env=env, check=True)
+
+    run(1, f"cache = MessageCache(lifetime=60, wal_path={str(path)!r})\n"
+           "cache.add_sent_messages(['a', b'b', 'c'])\n"
+           "cache.close()\n")
+    run(2, f"cache = MessageCache(lifetime=60, wal_path={str(path)!r})\n"
+           "assert len(cache) == 3\n"
+           "assert cache.receive_message('a') is not None\n"
+           "assert cache.receive_message(b'b') is not None\n"
+           "cache.close()\n")
+    assert set(WriteAheadLog.replay(path)) == {CacheEntry._extract_id('c')}
 
 
 if __name__ == "__main__":
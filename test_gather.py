@@ -0,0 +1,294 @@
+import sys
+import json
+import math
+import asyncio
+import pytest
+from unittest import mock
+from pathlib import Path
+from importlib.machinery import SourceFileLoader
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+
+ROOT = Path(__file__).parent
+FIXTURES = ROOT / 'fixtures' / 'traces'
+# maestro finds its deployment configs next to sys.argv[0]
+with mock.patch.object(sys, 'argv', [str(ROOT / 'maestro')]):
+    maestro = SourceFileLoader('maestro', str(ROOT / 'maestro')).load_module()
+
+
+def _gather(output, dumps=FIXTURES):
+    maestro._gather_from_dumps({'from': [str(dumps)], 'output': str(output), 'csv': False})
+    return pd.read_parquet(output / 'traces.parquet'), pd.read_parquet(output / 'traces.partial.parquet')
+
+
+def test_ingest_dumps_again(tmp_path):
+    traces, partial = _gather(tmp_path)
+    info = (tmp_path / 'traces.info').read_text()
+    assert len(traces) > 0
+    # every dump holds the same traces, and ingesting them again saves nothing new
+    again, partial_again = _gather(tmp_path)
+    assert len(again) == len(traces) and len(partial_again) == len(partial)
+    assert sorted(again['ts']) == sorted(traces['ts'])
+    assert (tmp_path / 'traces.info').read_text() == info
+
+
+def test_checkpoint_prunes_ids_before_high_water(tmp_path):
+    checkpoint = maestro._GatherCheckpoint(tmp_path)
+    high_water_us = 1000 * 1000000
+    slack_us = maestro.JAEGER_LOOKBACK_SLACK * 1000000
+    checkpoint.high_water_us = high_water_us
+    checkpoint.trace_ids = {'old': high_water_us - slack_us - 1, 'recent': high_water_us - slack_us, 'after': high_water_us + 1, 'no-start': None}
+    checkpoint.save()
+    assert set(json.loads((tmp_path / 'traces.checkpoint.json').read_text())['trace_ids']) == {'recent', 'after', 'no-start'}
+    assert set(maestro._GatherCheckpoint(tmp_path).trace_ids) == {'recent', 'after', 'no-start'}
+
+
+def test_resume_interrupted_ingestion(tmp_path, monkeypatch):
+    dump = FIXTURES / 'jaeger-compose-post.json'
+    traces, partial = _gather(tmp_path / 'clean', dump)
+
+    monkeypatch.setattr(maestro, 'TRACES_ROW_GROUP_SIZE', 10)
+    parse = maestro._parse_compose_post_service_trace
+    parsed = 0
+
+    def crash(trace):
+        nonlocal parsed
+        parsed += 1
+        if parsed > 55:
+            raise KeyboardInterrupt
+        return parse(trace)
+
+    monkeypatch.setattr(maestro, '_parse_compose_post_service_trace', crash)
+    with pytest.raises(KeyboardInterrupt):
+        _gather(tmp_path / 'resumed', dump)
+    checkpoint = json.loads((tmp_path / 'resumed' / 'traces.checkpoint.json').read_text())
+    # progress is kept per dump, not per trace
+    assert checkpoint['trace_ids'] == {} and checkpoint['dumps']['done'] == []
+    assert checkpoint['dumps']['current'] == str(dump) and 0 < checkpoint['dumps']['traces'] <= 55
+
+    monkeypatch.setattr(maestro, '_parse_compose_post_service_trace', parse)
+    resumed, partial_resumed = _gather(tmp_path / 'resumed', dump)
+    assert sorted(resumed['ts']) == sorted(traces['ts'])
+    assert len(partial_resumed) == len(partial)
+    checkpoint = json.loads((tmp_path / 'resumed' / 'traces.checkpoint.json').read_text())
+    assert checkpoint['dumps'] == {'done': [str(dump)], 'current': None, 'traces': 0}
+
+
+def test_dump_formats_agree():
+    traces = {}
+    for dump in sorted(FIXTURES.iterdir()):
+        infos = {}
+        maestro._ingest_trace_dump(dump, infos.__setitem__)
+        traces[dump.suffix] = infos
+    assert len(traces['.json']) == 120
+    assert traces['.json'] == traces['.jsonl'] == traces['.pb']
+
+
+def test_otlp_traces_are_yielded_once_complete():
+    def span(name):
+        return {'operationName': name, 'startTime': 0, 'tags': []}
+
+    read = []
+
+    def spans():
+        for trace_id, name in [('a', 'x'), ('b', 'x'), ('a', 'y'), ('a', 'z'), ('b', 'z')]:
+            read.append(trace_id)
+            yield trace_id, span(name)
+
+    traces = maestro._otlp_traces(spans(), ['x', 'y'])
+    first = next(traces)
+    # 'a' comes out before the rest of the file is read, and its later spans are dropped
+    assert first['traceID'] == 'a' and len(first['spans']) == 2 and len(read) == 3
+    rest = list(traces)
+    assert [t['traceID'] for t in rest] == ['b'] and len(rest[0]['spans']) == 2
+
+
+def test_empty_dump_is_skipped(tmp_path):
+    dumps = tmp_path / 'dumps'
+    dumps.mkdir()
+    (dumps / 'empty.json').write_bytes(b'')
+    (dumps / 'traces.json').write_bytes((FIXTURES / 'jaeger-compose-post.json').read_bytes())
+    traces, partial = _gather(tmp_path / 'gather', dumps)
+    assert len(traces) + len(partial) == 120
+
+
+
+# Stands in for the aiohttp session gather talks to jaeger with, `respond(url, params)` gives (status, body)
+class _StubJaegerSession:
+
+    class _Response:
+
+        def __init__(self, status, body):
+            self.status = status
+            self.body = json.dumps(body).encode()
+            self.content = self
+
+        async def read(self, n=-1):
+            data, self.body = (self.body, b'') if n < 0 else (self.body[:n], self.body[n:])
+            return data
+
+        async def json(self):
+            return json.loads(self.body)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def get(self, url, params):
+        params = dict(params)
+        self.requests.append((url, params))
+        return self._Response(*self.respond(url, params))
+
+
+def test_full_windows_are_split(monkeypatch):
+    monkeypatch.setattr(maestro, 'JAEGER_PAGE_LIMIT', 3)
+    # traces last 2us, jaeger returns the ones with a span in [start, end]
+    starts = [0, 5, 8, 9, 40, 60, 95]
+    full = []
+    returned = []
+
+    def respond(url, params):
+        data = [{'traceID': str(t), 'spans': []} for t in starts if t <= params['end'] and t + 2 >= params['start']]
+        if len(data) >= params['limit']:
+            full.append((params['start'], params['end']))
+        returned.extend(t['traceID'] for t in data[:params['limit']])
+        return 200, {'data': data[:params['limit']]}
+
+    session = _StubJaegerSession(respond)
+    traces = []
+    asyncio.run(maestro._fetch_jaeger_window(session, 'http://jaeger', 'compose-post-service', (0, 99), traces.append))
+    # every trace once, even the ones that end up in both halves of a split window
+    assert sorted(int(t['traceID']) for t in traces) == starts
+    assert len(returned) > len(set(returned))
+    windows = [(params['start'], params['end']) for _, params in session.requests]
+    assert full[:2] == [(0, 99), (0, 49)]
+    # a full window is fetched again as two halves that do not share an end
+    for start, end in full:
+        middle = (start + end) // 2
+        assert (start, middle) in windows and (middle + 1, end) in windows
+    assert len(windows) == 1 + 2 * len(full)
+
+
+def test_jaeger_get_retries_with_backoff(monkeypatch):
+    monkeypatch.setattr(maestro, 'JAEGER_RETRIES', 4)
+    monkeypatch.setattr(maestro, 'JAEGER_RETRY_BACKOFF', 1)
+    monkeypatch.setattr(maestro, 'JAEGER_RETRY_MAX_BACKOFF', 3)
+    backoffs = []
+
+    async def sleep(seconds):
+        backoffs.append(seconds)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+
+    async def body(response):
+        return await response.json()
+
+    def get(statuses):
+        session = _StubJaegerSession(lambda url, params: (statuses.pop(0), {'data': []}))
+        return asyncio.run(maestro._jaeger_get(session, 'http://jaeger/api/traces', (), body)), session
+
+    # server errors are retried, doubling the wait up to JAEGER_RETRY_MAX_BACKOFF
+    response, session = get([503, 502, 500, 200])
+    assert response == {'data': []} and len(session.requests) == 4
+    assert backoffs == [1, 2, 3]
+    # and give up after JAEGER_RETRIES
+    backoffs.clear()
+    with pytest.raises(SystemExit):
+        get([503] * 5)
+    assert backoffs == [1, 2, 3, 3]
+    # so is jaeger being unreachable
+    backoffs.clear()
+    aiohttp = pytest.importorskip('aiohttp')
+    errors = [aiohttp.ClientConnectionError('refused')]
+
+    def respond(url, params):
+        if errors:
+            raise errors.pop()
+        return 200, {'data': []}
+
+    session = _StubJaegerSession(respond)
+    assert asyncio.run(maestro._jaeger_get(session, 'http://jaeger/api/traces', (), body)) == {'data': []}
+    assert backoffs == [1]
+    # client errors are not retried
+    backoffs.clear()
+    with pytest.raises(SystemExit):
+        get([404])
+    assert backoffs == []
+
+
+def test_missing_bitmask_per_stage():
+    table = maestro.COMPOSE_POST_SERVICE_TRACE_TABLE
+    traces = json.loads((FIXTURES / 'jaeger-compose-post.json').read_text())['data']
+    masks = [maestro._parse_trace(trace, table)['missing'] for trace in traces]
+    # the fixture drops the _UploadHomeTimelineHelper span of 8 traces, entry 8 of the table
+    assert sorted(set(masks)) == [0, 1 << 8] and masks.count(1 << 8) == 8
+    assert maestro._missing_stages(1 << 8, table) == ['_UploadHomeTimelineHelper']
+
+    complete = traces[masks.index(0)]
+    info = maestro._parse_trace(complete, table)
+    spans = {span['operationName']: span for span in complete['spans']}
+    assert info['ts'] == spans['/wrk2-api/post/compose']['startTime'] * 1000
+    assert info['notification_size_bytes'] == next(t['value'] for t in spans['FanoutHomeTimelines']['tags'] if t['key'] == 'notification_size_bytes')
+
+    def without(operation=None, tag=None):
+        trace = json.loads(json.dumps(complete))
+        trace['spans'] = [span for span in trace['spans'] if span['operationName'] != operation]
+        for span in trace['spans']:
+            span['tags'] = [t for t in span['tags'] if t['key'] != tag]
+        return maestro._parse_trace(trace, table)
+
+    missing = without(operation='StorePost')
+    assert missing['missing'] == 1 << 2 and missing['poststorage_post_written_ts'] is None
+    # one bit for every entry of a missing span, the stage is reported once
+    fanout = without(operation='FanoutHomeTimelines')['missing']
+    assert fanout == sum(1 << i for i in (3, 4, 5, 6, 7, 9))
+    assert maestro._missing_stages(fanout | 1 << 2, table) == ['StorePost', 'FanoutHomeTimelines']
+    # a span without one of its tags only misses that entry
+    assert without(tag='consistency_bool')['missing'] == 1 << 4
+
+
+def test_stage_drop_rates(tmp_path):
+    traces, partial = _gather(tmp_path, FIXTURES / 'jaeger-compose-post.json')
+    assert len(traces) == 112 and len(partial) == 8
+    # partial traces keep what they have and the bitmask of what they miss
+    assert set(partial['missing']) == {1 << 8} and partial['wht_queue_duration'].isna().all()
+    assert partial['post_notification_diff_ms'].notna().all()
+    info = maestro._load_yaml(tmp_path / 'info.yml')
+    assert info['missing_info'] == 8
+    assert dict(info['stage_drop_rates']) == {
+        '/wrk2-api/post/compose': 0.0,
+        '_ComposeAndUpload': 0.0,
+        'StorePost': 0.0,
+        'FanoutHomeTimelines': 0.0,
+        '_UploadHomeTimelineHelper': 8 / 120,
+    }
+
+
+def test_derived_metrics():
+    sent_ns = 1700000000123456789
+    columns = {
+        'ts': [sent_ns, sent_ns],
+        'poststorage_post_written_ts': [1700000000130, 1700000000130],
+        'poststorage_read_notification_ts': [1700000000207, 1700000000250],
+        'wht_start_queue_ts': [1700000000140.5, 1700000000140.5],
+        'wht_start_worker_ts': [1700000000150.75, 1700000000141.0],
+    }
+    derived = maestro._derived_metrics(dict(columns))
+    assert list(derived['post_notification_diff_ms']) == [77.0, 120.0]
+    assert list(derived['wht_queue_duration']) == [10.25, 0.5]
+    assert list(derived['wht_vl_duration']) == [83.543211, 126.543211]
+
+    # partial traces keep the same precision, and NaN for what they miss
+    partial = {c: values + [None] for c, values in columns.items()}
+    derived = maestro._derived_metrics(partial, nullable=True)
+    assert list(derived['wht_vl_duration'][:2]) == [83.543211, 126.543211]
+    assert list(derived['post_notification_diff_ms'][:2]) == [77.0, 120.0]
+    for metric in ('post_notification_diff_ms', 'wht_queue_duration', 'wht_vl_duration'):
+        assert derived[metric].dtype == 'float64' and math.isnan(derived[metric][2])
@@ -0,0 +1,107 @@
+import os
+import sys
+import shutil
+import pytest
+from pathlib import Path
+from unittest import mock
+from importlib.machinery import SourceFileLoader
+
+pytest.importorskip('pyarrow')
+pytest.importorskip('seaborn')
+
+ROOT = Path(__file__).parent
+FIXTURES = ROOT / 'fixtures'
+# both scripts find their paths next to sys.argv[0]
+with mock.patch.object(sys, 'argv', [str(ROOT / 'maestro')]):
+    maestro = SourceFileLoader('maestro', str(ROOT / 'maestro')).load_module()
+    plot = SourceFileLoader('plot', str(ROOT / 'plot')).load_module()
+
+
+@pytest.fixture(autouse=True)
+def plots_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(plot, 'PLOTS_PATH', tmp_path / 'plots')
+    monkeypatch.setattr(plot, 'PLOTS_CACHE_PATH', tmp_path / 'plots' / '.cache')
+    monkeypatch.setattr(plot, '_GATHER_RUNS', {})
+    monkeypatch.setattr(plot, '_SAVED_PLOTS', {})
+    (tmp_path / 'plots').mkdir()
+
+
+# Gather dir with the fixture traces and wrk2 output
+def _gather_dir(path):
+    maestro._gather_from_dumps({'from': [str(FIXTURES / 'traces' / 'jaeger-compose-post.json')], 'output': str(path), 'csv': False})
+    shutil.copy(FIXTURES / 'wrk2' / 'client00.out', path / 'client00.out')
+    return path
+
+
+def _touch(path):
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def test_gather_runs_are_cached(tmp_path, monkeypatch):
+    gather = _gather_dir(tmp_path / 'gather')
+    parse = plot._parse_gather
+    parsed = []
+    monkeypatch.setattr(plot, '_parse_gather', lambda gather_path: parsed.append(gather_path) or parse(gather_path))
+
+    run, = plot._load_gathers([gather])
+    assert run.wrk2.requests == 6000 and run.consistent_count + run.inconsistent_count > 0
+    # from memory, then from PLOTS_CACHE_PATH in a new run
+    plot._load_gathers([gather])
+    plot._GATHER_RUNS.clear()
+    assert [plot._gather_run_to_dict(r) for r in plot._load_gathers([gather])] == [plot._gather_run_to_dict(run)]
+    assert len(parsed) == 1
+    _touch(gather / 'traces.parquet')
+    plot._GATHER_RUNS.clear()
+    plot._load_gathers([gather])
+    assert len(parsed) == 2
+
+
+def test_parallel_parse(tmp_path, monkeypatch):
+    gathers = [_gather_dir(tmp_path / f"gather{i}") for i in range(3)]
+    (gathers[1] / 'client00.out').unlink()
+    serial = [plot._gather_run_to_dict(run) for run in plot._load_gathers(gathers, workers=1)]
+    monkeypatch.setattr(plot, 'PLOTS_CACHE_PATH', tmp_path / 'parallel-cache')
+    plot._GATHER_RUNS.clear()
+    parallel = [plot._gather_run_to_dict(run) for run in plot._load_gathers(gathers, workers=2)]
+    assert parallel == serial
+    assert serial[1]['wrk2'] is None and serial[0]['wrk2'] is not None
+
+
+def test_cached_frame(tmp_path):
+    gather = _gather_dir(tmp_path / 'gather')
+    built = []
+
+    def aggregate():
+        built.append(1)
+        return plot.pd.DataFrame({'runs': [len(built)]})
+
+    assert plot._cached_frame('test', [gather], aggregate)['runs'][0] == 1
+    assert plot._cached_frame('test', [gather], aggregate)['runs'][0] == 1
+    _touch(gather / 'traces.parquet')
+    assert plot._cached_frame('test', [gather], aggregate)['runs'][0] == 2
+    # only the latest frame of a plot is kept
+    assert len(list((plot.PLOTS_CACHE_PATH / 'frames').glob('test-*.pickle'))) == 1
+
+
+def test_incremental_plots(tmp_path, monkeypatch):
+    gather = _gather_dir(tmp_path / 'gather')
+    drawn = []
+
+    def plot__test(gather_paths):
+        drawn.append(gather_paths)
+        plot.plt.figure()
+        plot.plt.plot([1, 2])
+        plot._save_plot('test')
+        plot.plt.close()
+
+    monkeypatch.setattr(plot, 'plot__test', plot__test, raising=False)
+    plot._draw_plots(['test'], {'test': [gather]}, incremental=True)
+    plot._draw_plots(['test'], {'test': [gather]}, incremental=True)
+    assert len(drawn) == 1
+    # without --incremental, or once a gather dir changed, the plot is drawn again
+    plot._draw_plots(['test'], {'test': [gather]})
+    assert len(drawn) == 2
+    _touch(gather / 'traces.parquet')
+    plot._draw_plots(['test'], {'test': [gather]}, incremental=True)
+    assert len(drawn) == 3
@@ -0,0 +1,44 @@
+from trace_summary import *
+import pytest
+
+
+def test_quantiles():
+    values = np.random.default_rng(1).lognormal(3, 1, 10000)
+    summary = QuantileSummary()
+    summary.add_many(values)
+    assert len(summary) == 10000
+    assert summary.min == values.min() and summary.max == values.max()
+    for q in (.25, .5, .75, .9, .99):
+        expected = np.quantile(values, q, method='inverted_cdf')
+        assert abs(summary.quantile(q) - expected) / expected < 2 ** -SUMMARY_PRECISION
+    assert abs(summary.mean() - values.mean()) < 1e-6
+    assert abs(summary.std() - values.std(ddof=1)) < 1e-6
+    assert QuantileSummary().quantile(.5) is None
+
+
+def test_negative_values_and_nans():
+    summary = QuantileSummary()
+    summary.add_many([-100.0, -1.0, 0.0, 0.0, 5.0, float('nan')])
+    assert len(summary) == 5
+    assert summary.quantile(0) == -100.0
+    assert abs(summary.quantile(.4) + 1) < 2 ** -SUMMARY_PRECISION
+    assert summary.quantile(.6) == 0.0
+    assert summary.quantile(1) == 5.0
+
+
+def test_merge_and_serialization():
+    rng = np.random.default_rng(2)
+    first, second = rng.normal(50, 20, 5000), rng.normal(80, 5, 5000)
+    a, b, combined = QuantileSummary(), QuantileSummary(), QuantileSummary()
+    a.add_many(first)
+    b.add_many(second)
+    combined.add_many(np.concatenate([first, second]))
+    # merging rounds is the same as summarizing everything at once
+    merged = merge_summaries([{'total': {'x': a}}, {'total': {'x': b}}])['total']['x']
+    assert merged.positive == combined.positive and merged.negative == combined.negative
+    assert merged.quantile(.9) == combined.quantile(.9)
+    with pytest.raises(ValueError):
+        a.merge(QuantileSummary(precision=4))
+    restored = summaries_from_dict(json.loads(json.dumps(summaries_to_dict({'total': {'x': merged}}))))['total']['x']
+    assert restored.to_dict() == merged.to_dict()
+    assert restored.describe([.5, .9]).keys() == {'count', 'mean', 'std', 'min', '50%', '90%', 'max'}
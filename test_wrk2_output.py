@@ -0,0 +1,100 @@
+from wrk2_output import *
+import json
+import pytest
+from pathlib import Path
+
+FIXTURE = Path(__file__).parent / 'fixtures' / 'wrk2' / 'client00.out'
+
+
+def test_parse():
+    output = load_wrk2_output(FIXTURE)
+    assert output.requests == 6000 and output.duration_s == 60.0
+    assert output.throughput == 99.97
+    assert output.errors == 3
+    assert len(output.corrected) == 6000 and output.corrected.max == 19.565
+    assert output.corrected.mean == 3.723 and output.corrected.stdev == 1.949
+    # the spectrum agrees with the percentile summary wrk2 prints
+    assert round(output.corrected.quantile(.9), 2) == 6.24
+    assert round(output.corrected.quantile(.5), 2) == 3.3
+    assert output.corrected.quantile(1) == 19.565
+    assert output.uncorrected is not None and len(output.uncorrected) == 6000
+    assert output.uncorrected.quantile(.9) < output.corrected.quantile(.9)
+
+
+def test_summary_only():
+    output = parse_wrk2_output(
+        "  Latency Distribution (HdrHistogram - Recorded Latency)\n"
+        " 50.000%  800.00us\n"
+        " 90.000%    1.50s\n"
+        "100.000%    1.10m\n"
+        "Requests/sec:     12.50\n")
+    assert output.corrected.quantile(.5) == 0.8
+    assert output.corrected.quantile(.9) == 1500.0
+    assert output.corrected.quantile(.95) == 66000.0
+    assert output.uncorrected is None
+    with pytest.raises(ValueError):
+        output.corrected._buckets()
+
+
+def test_merge_summary_only():
+    def summary(p50, p90):
+        return parse_wrk2_output(
+            "  Latency Distribution (HdrHistogram - Recorded Latency)\n"
+            f" 50.000%    {p50}\n"
+            f" 90.000%    {p90}\n"
+            "Requests/sec:     10.00\n")
+
+    merged = merge_wrk2_outputs([summary('1.00ms', '9.00ms'), summary('2.00ms', '3.00ms')])
+    # without counts every percentile falls back to the slowest client
+    assert merged.clients == 2 and merged.throughput == 20.0
+    assert merged.corrected.quantile(.5) == 2.0 and merged.corrected.quantile(.9) == 9.0
+    # and so does a summary merged with a full spectrum
+    full = load_wrk2_output(FIXTURE).corrected
+    merged.corrected.merge(full)
+    assert merged.corrected.quantile(.5) == full.quantile(.5) and merged.corrected.quantile(.9) == 9.0
+    assert merged.corrected.max == full.max
+
+
+def test_merge_without_footer():
+    # e.g. an output cut short after the spectrum, without the #[Mean and #[Max lines
+    text = FIXTURE.read_text()
+    truncated = parse_wrk2_output(text[:text.index('#[Mean')])
+    assert len(truncated.corrected) == 0 and truncated.corrected.spectrum
+    merged = LatencyDistribution()
+    merged.merge(truncated.corrected)
+    merged.merge(load_wrk2_output(FIXTURE).corrected)
+    assert len(merged) == 12000 and merged.spectrum[-1][1] == 1.0
+    assert merged.quantile(.9) == load_wrk2_output(FIXTURE).corrected.quantile(.9)
+    assert merged.mean is None
+
+
+def test_merge_single_output():
+    output = load_wrk2_output(FIXTURE)
+    assert merge_wrk2_outputs([output]) is output
+    assert merge_wrk2_outputs(iter([output])) is output
+
+
+def test_merge_and_serialization():
+    first, second = load_wrk2_output(FIXTURE).corrected, load_wrk2_output(FIXTURE).corrected
+    merged = LatencyDistribution()
+    merged.merge(first)
+    merged.merge(second)
+    # the same run twice has the same distribution, with twice the requests
+    assert len(merged) == 12000 and merged.max == first.max
+    assert abs(merged.mean - first.mean) < 1e-9 and abs(merged.stdev - first.stdev) < 1e-9
+    for q in (.5, .9, .99, 1):
+        assert merged.quantile(q) == first.quantile(q)
+    restored = Wrk2Output.from_dict(json.loads(json.dumps(load_wrk2_output(FIXTURE).to_dict())))
+    assert restored.to_dict() == load_wrk2_output(FIXTURE).to_dict()
+
+
+def test_client_outputs(tmp_path):
+    assert load_client_outputs(tmp_path) is None
+    for name in ('client00.out', 'client01.out'):
+        (tmp_path / name).write_text(FIXTURE.read_text())
+    (tmp_path / 'info.yml').write_text("rps: 100\n")
+    single, merged = load_wrk2_output(FIXTURE), load_client_outputs(tmp_path)
+    assert merged.clients == 2 and merged.requests == 12000 and merged.errors == 6
+    assert merged.throughput == 2 * single.throughput and merged.duration_s == single.duration_s
+    assert merged.corrected.quantile(.9) == single.corrected.quantile(.9)
+    assert merged.uncorrected.quantile(.9) == single.uncorrected.quantile(.9)
@@ -0,0 +1,168 @@
+import math
+import json
+import numpy as np
+
+# Streaming, mergeable summaries of the trace metrics
+# gather builds them while it parses traces and saves them next to the traces, so percentiles of a round, or of
+#   several rounds merged together, do not need the raw traces
+# Values go into log-linear buckets like an HdrHistogram: 2**precision buckets per power of two, so quantiles are
+#   within 2**-precision relative error, and negative values (clock skew between regions) get buckets of their own
+# cache.LatencyHistogram is the same idea on whole microseconds, one value at a time and without numpy, since it
+#   runs in the publishers. The metrics here are floats of any unit and sign, so they are bucketed with np.frexp
+
+SUMMARY_PRECISION = 7
+
+
+class QuantileSummary:
+
+    def __init__(self, precision: int = SUMMARY_PRECISION) -> None:
+        self.precision = precision
+        # bucket key -> count, for the magnitude of positive and negative values
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _keys(self, magnitudes: np.ndarray) -> np.ndarray:
+        # magnitude = mantissa * 2**exponent with the mantissa in [0.5, 1)
+        mantissas, exponents = np.frexp(magnitudes)
+        buckets = 1 << self.precision
+        return exponents.astype(np.int64) * buckets + ((mantissas * 2 - 1) * buckets).astype(np.int64)
+
+    # Middle of the bucket
+    def _magnitude(self, key: int) -> float:
+        exponent, bucket = divmod(key, 1 << self.precision)
+        return math.ldexp((1 + (bucket + 0.5) / (1 << self.precision)) / 2, exponent)
+
+    # Adds a whole column of values at once, NaNs are skipped
+    def add_many(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.total_squares += float(np.square(values).sum())
+        self.min = float(values.min()) if self.min is None else min(self.min, float(values.min()))
+        self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+        self.zeros += int((values == 0).sum())
+        for buckets, magnitudes in ((self.positive, values[values > 0]), (self.negative, -values[values < 0])):
+            keys, counts = np.unique(self._keys(magnitudes), return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                buckets[key] = buckets.get(key, 0) + count
+
+    def merge(self, other: "QuantileSummary") -> None:
+        if other.precision != self.precision:
+            raise ValueError("can only merge summaries with the same precision")
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_buckets.items():
+                buckets[key] = buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    # Value at quantile q (0-1), or None when empty
+    # def quantile(self, q: float) -> float | None:
+    def quantile(self, q: float):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * q))
+        seen = 0
+        # from the most negative value up
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen >= rank:
+                return max(-self._magnitude(key), self.min)
+        seen += self.zeros
+        if seen >= rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen >= rank:
+                return min(self._magnitude(key), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    # Sample standard deviation, like pandas
+    def std(self):
+        if self.count < 2:
+            return None
+        variance = (self.total_squares - self.total * self.total / self.count) / (self.count - 1)
+        return math.sqrt(max(variance, 0.0))
+
+    # Same rows as pandas describe(percentiles=...)
+    def describe(self, percentiles) -> dict:
+        description = {'count': self.count, 'mean': self.mean(), 'std': self.std(), 'min': self.min}
+        for q in percentiles:
+            description[f"{q * 100:g}%"] = self.quantile(q)
+        description['max'] = self.max
+        return description
+
+    def to_dict(self) -> dict:
+        return {
+            'precision': self.precision,
+            'count': self.count,
+            'total': self.total,
+            'total_squares': self.total_squares,
+            'min': self.min,
+            'max': self.max,
+            'zeros': self.zeros,
+            # json only has string keys
+            'positive': {str(key): count for key, count in self.positive.items()},
+            'negative': {str(key): count for key, count in self.negative.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "QuantileSummary":
+        summary = cls(d['precision'])
+        summary.count = d['count']
+        summary.total = d['total']
+        summary.total_squares = d['total_squares']
+        summary.min = d['min']
+        summary.max = d['max']
+        summary.zeros = d['zeros']
+        summary.positive = {int(key): count for key, count in d['positive'].items()}
+        summary.negative = {int(key): count for key, count in d['negative'].items()}
+        return summary
+
+
+# Summaries are grouped as {group: {metric: QuantileSummary}}, e.g. by consistency class
+def summaries_to_dict(summaries: dict) -> dict:
+    return {group: {metric: s.to_dict() for metric, s in metrics.items()} for group, metrics in summaries.items()}
+
+
+def summaries_from_dict(d: dict) -> dict:
+    return {group: {metric: QuantileSummary.from_dict(s) for metric, s in metrics.items()} for group, metrics in d.items()}
+
+
+def save_summaries(path, summaries: dict) -> None:
+    with open(path, 'w') as f:
+        json.dump(summaries_to_dict(summaries), f)
+
+
+def load_summaries(path) -> dict:
+    with open(path) as f:
+        return summaries_from_dict(json.load(f))
+
+
+# Merges the summaries of several rounds, group by group and metric by metric
+def merge_summaries(rounds) -> dict:
+    merged = {}
+    for summaries in rounds:
+        for group, metrics in summaries.items():
+            for metric, s in metrics.items():
+                merged.setdefault(group, {}).setdefault(metric, QuantileSummary(s.precision)).merge(s)
+    return merged
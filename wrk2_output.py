@@ -0,0 +1,229 @@
+import re
+import math
+from pathlib import Path
+
+# Parser for the output of wrk2 runs with --latency, as saved by the workload clients (e.g. client00.out)
+# wrk2 prints a percentile spectrum of its HdrHistogram for the corrected latency (and for the uncorrected one
+# with -U), which is kept whole so plots can pick any percentile and merge the distributions of several runs
+
+# wrk2 prints durations with these units, converted to ms
+WRK2_UNITS_MS = {'us': 0.001, 'ms': 1.0, 's': 1000.0, 'm': 60000.0, 'h': 3600000.0}
+
+
+class LatencyDistribution:
+
+    def __init__(self) -> None:
+        # (latency in ms, percentile 0-1, count up to it) as in the detailed percentile spectrum, counts are None
+        # when only the percentile summary was printed
+        self.spectrum: list[tuple[float, float, int]] = []
+        self.count = 0
+        self.mean = None
+        self.stdev = None
+        self.max = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Latency in ms at quantile q (0-1), or None when empty
+    # def quantile(self, q: float) -> float | None:
+    def quantile(self, q: float):
+        for value, percentile, _ in self.spectrum:
+            if percentile >= q:
+                return value
+        return self.spectrum[-1][0] if self.spectrum else None
+
+    # Latency in ms and number of requests for each distinct latency of the spectrum
+    def _buckets(self) -> list[tuple[float, int]]:
+        if any(total_count is None for _, _, total_count in self.spectrum):
+            raise ValueError("can only merge distributions with a detailed percentile spectrum")
+        buckets, previous = [], 0
+        for value, _, total_count in self.spectrum:
+            if total_count > previous:
+                buckets.append((value, total_count - previous))
+                previous = total_count
+        return buckets
+
+    # Same as if the requests of both had been recorded in one histogram, up to the resolution of the spectra
+    # Without counts (only the percentile summary was printed) each percentile takes the higher latency of
+    #   the two instead, which is an upper bound of the merged one
+    def merge(self, other: "LatencyDistribution") -> None:
+        if not other.spectrum:
+            return
+        if not self.spectrum:
+            self.spectrum, self.count, self.mean, self.stdev, self.max = list(other.spectrum), other.count, other.mean, other.stdev, other.max
+            return
+        if any(total_count is None for _, _, total_count in self.spectrum + other.spectrum):
+            percentiles = sorted({percentile for _, percentile, _ in self.spectrum + other.spectrum})
+            spectrum = [(max(self.quantile(p), other.quantile(p)), p, None) for p in percentiles]
+            count = self.count + other.count
+        else:
+            counts: dict[float, int] = {}
+            for value, count in self._buckets() + other._buckets():
+                counts[value] = counts.get(value, 0) + count
+            # requests in the spectra, the count from the #[Max footer is missing from truncated outputs
+            count = sum(counts.values())
+            spectrum, total_count = [], 0
+            for value in sorted(counts):
+                total_count += counts[value]
+                spectrum.append((value, total_count / count, total_count))
+        self.spectrum = spectrum
+        # pooled mean and (population) standard deviation, like HdrHistogram computes them
+        if count and None not in (self.mean, self.stdev, other.mean, other.stdev):
+            mean = (self.mean * self.count + other.mean * other.count) / count
+            squares = self.count * (self.stdev ** 2 + self.mean ** 2) + other.count * (other.stdev ** 2 + other.mean ** 2)
+            self.stdev = math.sqrt(max(squares / count - mean ** 2, 0.0))
+            self.mean = mean
+        else:
+            self.mean = self.stdev = None
+        self.max = max((m for m in (self.max, other.max) if m is not None), default=None)
+        self.count = count
+
+    def to_dict(self) -> dict:
+        return {
+            'spectrum': [list(entry) for entry in self.spectrum],
+            'count': self.count,
+            'mean': self.mean,
+            'stdev': self.stdev,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "LatencyDistribution":
+        distribution = cls()
+        distribution.spectrum = [tuple(entry) for entry in d['spectrum']]
+        distribution.count = d['count']
+        distribution.mean = d['mean']
+        distribution.stdev = d['stdev']
+        distribution.max = d['max']
+        return distribution
+
+
+class Wrk2Output:
+
+    def __init__(self) -> None:
+        # wrk2 outputs merged into this one
+        self.clients = 1
+        self.requests = 0
+        self.duration_s = 0.0
+        # requests/sec
+        self.throughput = None
+        # socket errors and non 2xx or 3xx responses
+        self.errors = 0
+        self.corrected = LatencyDistribution()
+        # only with wrk2 -U
+        self.uncorrected = None
+
+    def to_dict(self) -> dict:
+        return {
+            'clients': self.clients,
+            'requests': self.requests,
+            'duration_s': self.duration_s,
+            'throughput': self.throughput,
+            'errors': self.errors,
+            'corrected': self.corrected.to_dict(),
+            'uncorrected': None if self.uncorrected is None else self.uncorrected.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Wrk2Output":
+        output = cls()
+        output.clients = d['clients']
+        output.requests = d['requests']
+        output.duration_s = d['duration_s']
+        output.throughput = d['throughput']
+        output.errors = d['errors']
+        output.corrected = LatencyDistribution.from_dict(d['corrected'])
+        output.uncorrected = None if d['uncorrected'] is None else LatencyDistribution.from_dict(d['uncorrected'])
+        return output
+
+
+# Duration such as 1.50ms or 2.00s in ms
+def _duration_ms(text: str) -> float:
+    match = re.fullmatch(r'([\d.]+)(us|ms|s|m|h)', text)
+    if match is None:
+        raise ValueError(f"unknown wrk2 duration: {text}")
+    return float(match.group(1)) * WRK2_UNITS_MS[match.group(2)]
+
+
+def parse_wrk2_output(text: str) -> Wrk2Output:
+    output = Wrk2Output()
+    distribution = None
+    in_spectrum = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('Latency Distribution (HdrHistogram - Recorded Latency)'):
+            distribution, in_spectrum = output.corrected, False
+        elif stripped.startswith('Latency Distribution (HdrHistogram - Uncorrected Latency'):
+            output.uncorrected = LatencyDistribution()
+            distribution, in_spectrum = output.uncorrected, False
+        elif stripped.startswith('Detailed Percentile spectrum:') and distribution is not None:
+            distribution.spectrum, in_spectrum = [], True
+        elif stripped.startswith('#[Mean') and distribution is not None:
+            mean, stdev = re.findall(r'=\s*([\d.]+)', stripped)
+            distribution.mean, distribution.stdev = float(mean), float(stdev)
+        elif stripped.startswith('#[Max') and distribution is not None:
+            max_value, count = re.findall(r'=\s*([\d.]+)', stripped)
+            distribution.max, distribution.count = float(max_value), int(count)
+            # the spectrum ends with the summary of its histogram
+            in_spectrum = False
+        elif in_spectrum:
+            fields = stripped.split()
+            if len(fields) == 4 and fields[0][0].isdigit():
+                distribution.spectrum.append((float(fields[0]), float(fields[1]), int(fields[2])))
+        elif distribution is not None and re.fullmatch(r'[\d.]+%\s+\S+', stripped):
+            # percentile summary, e.g. " 90.000%    1.80ms", kept only until the detailed spectrum is read
+            percentile, value = stripped.split()
+            distribution.spectrum.append((_duration_ms(value), float(percentile[:-1]) / 100, None))
+        elif re.fullmatch(r'\d+ requests in [\d.]+\w+, .* read', stripped):
+            requests, _, _, duration = stripped.split(',')[0].split()
+            output.requests, output.duration_s = int(requests), _duration_ms(duration) / 1000
+        elif stripped.startswith('Requests/sec:'):
+            output.throughput = float(stripped.split(':')[1])
+        elif stripped.startswith('Socket errors:'):
+            output.errors += sum(int(n) for n in re.findall(r'\d+', stripped))
+        elif stripped.startswith('Non-2xx or 3xx responses:'):
+            output.errors += int(stripped.split(':')[1])
+    return output
+
+
+def load_wrk2_output(path) -> Wrk2Output:
+    with open(path) as f:
+        return parse_wrk2_output(f.read())
+
+
+# One output for the load of several clients run at the same time: throughputs add up and latencies are merged
+def merge_wrk2_outputs(outputs) -> Wrk2Output:
+    outputs = list(outputs)
+    if len(outputs) == 1:
+        return outputs[0]
+    merged = Wrk2Output()
+    merged.clients = 0
+    merged.throughput = 0.0
+    uncorrected = []
+    for output in outputs:
+        merged.clients += output.clients
+        merged.requests += output.requests
+        merged.duration_s = max(merged.duration_s, output.duration_s)
+        merged.throughput += output.throughput or 0.0
+        merged.errors += output.errors
+        merged.corrected.merge(output.corrected)
+        uncorrected.append(output.uncorrected)
+    # only when every client has it
+    if uncorrected and all(u is not None for u in uncorrected):
+        merged.uncorrected = LatencyDistribution()
+        for u in uncorrected:
+            merged.uncorrected.merge(u)
+    return merged
+
+
+# Every client writes its wrk2 output to a .out file of the gather dir (client00.out, $(hostname).out, ...)
+def client_output_files(gather_path) -> list:
+    return sorted(Path(gather_path).glob('*.out'))
+
+
+# Merged output of all the clients of a gather dir, or None when it has none
+def load_client_outputs(gather_path):
+    paths = client_output_files(gather_path)
+    if not paths:
+        return None
+    return merge_wrk2_outputs(load_wrk2_output(p) for p in paths)